@@ -1,8 +1,6 @@
 import dash
-import math
 import dash_core_components as dcc
 import dash_html_components as html
-import plotly.graph_objs as go
 import pandas as pd
 from datetime import datetime
 import numpy as np
@@ -10,146 +8,248 @@ import time
 import base64
 import yaml
 import os
-from flask_caching import Cache
-from data_extractor import DataExtractor
+import json
+import flask
+import atexit
+from flask_compress import Compress
+from data_extractor import DataExtractor, connect
+from connection_pool import ConnectionPool
+from data_store import DataStore
+from snapshot import SnapshotStore
+from file_lock import FileLock
+from refresher import RefreshScheduler
+from result_store import ResultStore, result_key
+from cube import build_cube, build_dimension_index, DROPDOWN_DIMENSIONS, METRICS
+from filter_index import FilterIndex
+from performance import DailyPerformance, RATIO_LINES
+from resampling import Resampler
+from sequential import SequentialMonitor, ALL_SEGMENTS
+from date_extents import build_date_extents
+from rollups import RESOLUTIONS, add_periods, build_hourly_cube, pick_resolution
+from instrumentation import registry, timer, timed, cache_lookup, instrument_server
+from json_api import EncodedPayload, not_modified, payload_response
 import time
 
 CACHE_TIMEOUT = 60*30 # every three hours
+REFRESH_INTERVAL = 60*30 # the data is reloaded in the background this often...
+REFRESH_OFFSET = 60*5 # ...at this many seconds past the interval, after gtemp_experimentdashboard is rebuilt
+DB_PARALLELISM = 4 # how many experiment queries run concurrently when extracting data
+DB_CHUNKSIZE = 100000 # rows read at a time from the db, typed as they arrive
+DB_PUSHDOWN = False # if True, redshift sums the metrics per dashboard dimensions and only the sums are fetched
+CONFIDENCE = 0.95 # coverage of the total performance bounds in the ratio plot
+RESAMPLES = 2000 # bootstrap resamples of the days behind those bounds, 0 uses the normal approximation instead
+RESAMPLING_SEED = 0 # fixed, so every worker draws the same bounds for the same filters
+RESOLUTION_MIN_POINTS = 10 # the automatic resolution is the coarsest one giving the plots at least this many points
+SEQUENTIAL_TAU2 = 0.01 # mixture variance of the always valid bounds, around the squared relative lifts worth detecting
+FILTERED_DATA_MAX_BYTES = 200 * 1024**2 # memory budget for filtered frames and figures kept per process
+TRACE_REQUESTS = os.environ.get('TRACE_REQUESTS') == '1' # if set, every request is logged as a JSON line with its trace ID and stage timings
 README_CONTENT = open('help.md', 'r').read()
 LOGO = 'imgs/logo.jpg'
 
-# Because callbacks run in paralell, this is needed in order to prevent the db from being called 
-# multiple times
-global LOADING_DB_DATA
-LOADING_DB_DATA = False
-
 # if the caching location is defined, it will try to load the data from there.
-# if it is None, then it will fetch from the DB
+# if it is None, then it will fetch from the DB. It can also be set with the CSV_LOCATION
+# environment variable, as the benchmarks do
 #CSV_LOCATION = "data.csv"
-CSV_LOCATION = None
+CSV_LOCATION = os.environ.get('CSV_LOCATION')
 
 
 # the path for the exp config file
-EXP_PARAMS_PATH = "experiment_config.yaml"
+EXP_PARAMS_PATH = os.environ.get('EXP_PARAMS_PATH', "experiment_config.yaml")
 
 # define the app globally
 app = dash.Dash(__name__)
 server = app.server
 
+# stage latencies, cache lookups and response sizes of this worker are served on /metrics
+instrument_server(server, trace=TRACE_REQUESTS)
+
+# gzips the dash responses, the api responses are stored gzipped already
+Compress(server)
+
 
 
 # set up caching folder and system
-cache_folder = "cache"
+cache_folder = os.environ.get('CACHE_FOLDER', "cache")
 
 if not os.path.exists(cache_folder):
     os.makedirs(cache_folder)
 
-cache = Cache(app.server, config={
-    'CACHE_TYPE': 'filesystem',
-    'CACHE_DIR': cache_folder,
-    'CACHE_THRESHOLD': 5
-})
+# extracted data is also kept per experiment and day, so a refresh only queries new days
+partitions_folder = os.path.join(cache_folder, 'partitions')
+
+# the db connections and the threads of the parallel queries are reused by every extraction of this process
+db_pool = ConnectionPool(connect, DB_PARALLELISM)
+atexit.register(db_pool.close)
+
+# loaded data is saved as a columnar snapshot that every worker of the node can memory map
+snapshots = SnapshotStore(os.path.join(cache_folder, 'snapshots'))
 
 
 # load experiment descriptions and check length
-experiments_params = yaml.load(open('experiment_config.yaml', 'r'))
+experiments_params = yaml.load(open(EXP_PARAMS_PATH, 'r'))
 for key, value in experiments_params.iteritems():
     assert len(value['description']) < 572, "experiment description has to have less than 572 characters"
 
-def dataframe():
-    ''' Reloads the main dataframe used for this application '''
-    exp_params = yaml.load(open(EXP_PARAMS_PATH, 'r'))
-    return pd.read_json(load_data(exp_params), orient='split')
-
-
-@cache.memoize(timeout=CACHE_TIMEOUT)
+# the always valid bounds of every experiment, arm and segment, fed only the new final days of every loaded version
+sequential_monitor = SequentialMonitor(alpha=1 - CONFIDENCE, tau2=SEQUENTIAL_TAU2)
+
+# the builders of what is derived from every loaded version of the data, each gets the data
+# and what the builders before it derived
+@timed('build_cube')
+def build_cube_with_periods(data, derived):
+    ''' Builds the cube with the week and month labels '''
+    return add_periods(build_cube(data))
+
+@timed('build_filter_index')
+def build_index(data, derived):
+    ''' Builds the filter index over the cube '''
+    return FilterIndex(derived['cube'])
+
+@timed('build_hourly_cube')
+def build_hourly(data, derived):
+    ''' Builds the hourly cube, or None if the data has no hours '''
+    return build_hourly_cube(data)
+
+@timed('build_hourly_filter_index')
+def build_hourly_index(data, derived):
+    ''' Builds the filter index over the hourly cube, if there is one '''
+    return FilterIndex(derived['hourly_cube']) if derived['hourly_cube'] is not None else None
+
+@timed('build_dimensions')
+def build_dimensions(data, derived):
+    ''' Builds the distinct values of every dropdown dimension '''
+    return build_dimension_index(data)
+
+@timed('build_date_extents')
+def build_extents(data, derived):
+    ''' Builds the date slider state of every experiment '''
+    return build_date_extents(derived['cube'])
+
+@timed('build_sequential')
+def build_monitor(data, derived):
+    ''' Catches the sequential monitor up with the final days of the data '''
+    return sequential_monitor.update(derived['filter_index'])
+
+# the loaded data lives in memory and is shared by all callbacks of this process, the
+# snapshot on disk is only read when this store is empty or stale. The cube with the metric
+# sums per dimension values (with week and month labels), the same per hour if the data has
+# hours, the filter indexes over them, the dropdown values and the date slider states are built once
+# per loaded version of the data, and the sequential monitor catches up with it. Only one
+# worker of the node loads new data at a time, the others wait for its snapshot
+data_store = DataStore(max_age=CACHE_TIMEOUT,
+                       builders=[('cube', build_cube_with_periods),
+                                 ('filter_index', build_index),
+                                 ('hourly_cube', build_hourly),
+                                 ('hourly_filter_index', build_hourly_index),
+                                 ('dimensions', build_dimensions),
+                                 ('date_extents', build_extents),
+                                 ('sequential', build_monitor)],
+                       snapshots=snapshots,
+                       refresh_lock=FileLock(os.path.join(cache_folder, 'refresh.lock')))
+
+def read_exp_params():
+    ''' Reads the current experiment configuration '''
+    return yaml.load(open(EXP_PARAMS_PATH, 'r'))
+
+def snapshot():
+    ''' Returns the current data snapshot used for this application, reloading it when stale '''
+    exp_params = read_exp_params()
+    cache_lookup('data', data_store.is_fresh(exp_params))
+    return data_store.get_snapshot(exp_params, lambda: load_data(exp_params))
+
+# draws the resampled bounds of the ratio plot, they are kept with the rest of the filtered results
+resampler = Resampler(RESAMPLES, CONFIDENCE, seed=RESAMPLING_SEED) if RESAMPLES else None
+
+# filtered frames and what is computed from them are kept on the server, the browser only gets the filters that produced them
+filtered_data_store = ResultStore(max_bytes=FILTERED_DATA_MAX_BYTES)
+
+
+def cached(cache, key, stage, compute):
+    ''' Returns the result stored under key, counting the lookup as a hit or miss of cache and timing compute() as stage on a miss '''
+    cache_lookup(cache, key in filtered_data_store)
+    return filtered_data_store.get_or_compute(key, timed(stage)(compute))
+
+
+registry.gauge('experiments_result_store_bytes', 'Estimated size of the filtered frames and figures kept by this worker',
+               lambda: [({}, filtered_data_store.size)])
+registry.gauge('experiments_result_store_entries', 'Number of filtered frames and figures kept by this worker',
+               lambda: [({}, len(filtered_data_store))])
+registry.gauge('experiments_data_age_seconds', 'Seconds since the data served by this worker was loaded',
+               lambda: [({}, time.time() - data_store.snapshot.loaded_at)] if data_store.snapshot else [])
+
+
+@timed('load_data')
 def load_data(exp_params):
-    ''' Loads the data from a CSV or from the db, and it will cache the results '''
-    start = time.time()
-
+    ''' Loads the data from a CSV or from the db, the data store saves it as a snapshot '''
     if CSV_LOCATION: # uses a global variable, ugly but prettier than passing it every time
         print "reading data from local csv"
-        df = pd.read_csv(CSV_LOCATION)
-    elif not LOADING_DB_DATA:
-        print "fetching data from db or cache"
-        global LOADING_DB_DATA
-        LOADING_DB_DATA = True
-        df = DataExtractor(exp_params).get_data()
-        LOADING_DB_DATA = False
-
+        with timer('read_csv'):
+            df = pd.read_csv(CSV_LOCATION)
     else:
-        print "waiting for query to end"
-        while (LOADING_DB_DATA):
-            time.sleep(1)
-        df = DataExtractor(exp_params).get_data()
+        print "fetching data from db or cache"
+        with timer('extract'):
+            df = DataExtractor(exp_params, partition_dir=partitions_folder, parallelism=DB_PARALLELISM,
+                               connection_pool=db_pool, chunksize=DB_CHUNKSIZE, pushdown=DB_PUSHDOWN).get_data()
 
 
     # get date to be a string and also saves the unix time for every date
     df['theday'] = df['theday'].astype('str')
+    if 'thehour' in df.columns:
+        df['thehour'] = df['thehour'].astype('str')
     df['thedayunix'] = pd.to_datetime(df['theday']).astype(np.int64) // 10**9
 
     # drop any empty values
     df = df.dropna()
 
-    end = time.time()
-    print "loading data took {} seconds".format(end - start)
+    return df
 
-    return df.to_json(date_format='iso', orient='split')
+# keeps the data warm in the background, so requests do not wait for the db
+refresh_scheduler = RefreshScheduler(data_store, read_exp_params, load_data,
+                                     interval=REFRESH_INTERVAL, offset=REFRESH_OFFSET)
+refresh_scheduler.start()
 
-def datetime_tounix(dt):
-    ''' Convert datetime to unix timestamp '''
-    return int(time.mktime(dt.timetuple()))
+@server.route('/refresh-status')
+def refresh_status():
+    ''' Reports when the data was last refreshed and how long it took '''
+    return flask.jsonify(refresh_scheduler.status())
 
-def get_marks(data, n):
+def dimension_index():
     '''
-    Get the marks for the dash graph based on the data series and how many intervals should be displayed
-
-    Args:
-        data: a pandas series of dates as ints in the unix format.
-        n: how many intervals should be in the marks
-
-    Examples:
-        if the data ranges from 2018-02-01 to 2018-02-21 and n = 4
-        then the output will be:
-            {unixdate: 2018-02-01, unixdate: 2018-02-07, unixdate: 2018-02-14, unixdate: 2018-02-21}
+    Returns the distinct values of the dropdown dimensions without loading the data.
 
-    returns:
-        a dictonary mapping a unix value to a string representing a date in the format YYYY-mm-dd
+    They come from the data of this process if it is loaded, otherwise from the metadata of
+    the snapshot on disk, and before the very first load the experiments come from the config.
+    Experiments that are in the data but no longer in the config are left out.
     '''
-
-    result = {}
-    # initialize a data range with every date from min to max in the df
-    daterange = pd.date_range(start=pd.to_datetime(data.min(),unit='s'),end=pd.to_datetime(data.max(), unit = 's'),freq='d')
-
-    # include the smallest and large dates first 
-    result[datetime_tounix(daterange.max())] = str(daterange.max().strftime('%Y-%m-%d'))
-    result[datetime_tounix(daterange.min())] = str(daterange.min().strftime('%Y-%m-%d'))
-
-    # if the remaining dates are smaller than the number of date points to include, just include all of them
-    if n > len(daterange) - 2:
-        for index, date in enumerate(daterange):
-            result[datetime_tounix(date)] = str(date.strftime('%Y-%m-%d'))
-
-    # otherwise calculate how many to include and include them evenly spaced
+    current = data_store.snapshot
+    if current is not None:
+        index = dict(current.derived['dimensions'])
     else:
-        days_per_interval = len(daterange) / n # get how many days per interval there should be
-        for index, date in enumerate(daterange):
-            if(index % days_per_interval == 0): # only include evenly spaced 
-                result[datetime_tounix(date)] = str(date.strftime('%Y-%m-%d'))
+        index = dict((column, []) for column in DROPDOWN_DIMENSIONS)
+        index['experimenttypename'] = sorted(experiments_params.keys())
+        index.update(snapshots.distinct_values(DROPDOWN_DIMENSIONS))
 
+    index['experimenttypename'] = [e for e in index.get('experimenttypename', []) if e in experiments_params]
+    return index
 
-    return result
 
+ENCODED_LOGO = []
+
+def encoded_logo():
+    ''' Returns the logo encoded in base64, reading the file only once '''
+    if not ENCODED_LOGO:
+        ENCODED_LOGO.append(base64.b64encode(open(LOGO, 'rb').read()))
+    return ENCODED_LOGO[0]
 
 
 def generate_layout():
-    ''' Generates the app layout '''
-    enconded_logo = base64.b64encode(open(LOGO, 'rb').read())
-    df = dataframe()
-    unique_experiments = df['experimenttypename'].unique()
-    unique_languages = df['culturekey'].unique()
-    unique_channels = df['channel'].unique()
-    unique_segments = df['segment'].unique()
+    ''' Generates the app layout, on every page load '''
+    enconded_logo = encoded_logo()
+    index = dimension_index()
+    unique_experiments = index['experimenttypename']
+    unique_languages = index['culturekey']
+    unique_channels = index['channel']
+    unique_segments = index['segment']
 
     return html.Div(children=[
         html.Img(src='data:image/png;base64,{}'.format(enconded_logo),
@@ -190,6 +290,14 @@ def generate_layout():
                 value = 'trial',
                 clearable = False
             ),
+            html.Label('Resolution', style = {'fontWeight':'bold'}),
+            dcc.Dropdown(
+                id='resolution-dropdown',
+                options=[{'label': 'automatic', 'value': 'auto'}] +
+                        [{'label': resolution, 'value': resolution} for resolution in RESOLUTIONS],
+                value = 'auto',
+                clearable = False
+            ),
             html.Label('Language', style = {'fontWeight':'bold'}),
             dcc.Dropdown(
                 id='language-id',
@@ -242,7 +350,9 @@ def generate_layout():
 
 
 
-app.layout = generate_layout()
+# the layout is a function so it is built from the current dimension values on every page load,
+# which also means starting a worker does not need any data
+app.layout = generate_layout
 
 
 
@@ -256,201 +366,329 @@ def update_description(experiment):
     return experiments_params[experiment]['description']
 
 
+def slider_state(experiment):
+    ''' Returns the min, max, marks and value of the date slider of an experiment, computed once per data version '''
+    return snapshot().derived['date_extents'].get(experiment, {'min': None, 'max': None, 'marks': {}, 'value': None})
+
+
+# dash can only update one property per callback, so each slider property is a lookup in the same slider state
 @app.callback(dash.dependencies.Output('theday-slider', 'min'),
               [dash.dependencies.Input('experiment-id', 'value')
                ])
-def update_slider(experiment):
+def update_slider_min(experiment):
     ''' Updates the date sliders min date '''
-    df = dataframe()
-    local_df = df[df['experimenttypename'] == experiment]
-    return local_df['thedayunix'].min()
+    return slider_state(experiment)['min']
 
 
 @app.callback(dash.dependencies.Output('theday-slider', 'max'),
               [dash.dependencies.Input('experiment-id', 'value')])
-def update_slider(experiment):
+def update_slider_max(experiment):
     ''' Updates the date sliders date '''
-    df = dataframe()
-    local_df = df[df['experimenttypename'] == experiment]
-    return local_df['thedayunix'].max()
+    return slider_state(experiment)['max']
 
 @app.callback(dash.dependencies.Output('theday-slider', 'marks'),
               [dash.dependencies.Input('experiment-id', 'value')])
-def update_slider(experiment):
+def update_slider_marks(experiment):
     ''' Updates the date sliders marks '''
-    df = dataframe()
-    local_df = df[df['experimenttypename'] == experiment]
-    return get_marks(local_df['thedayunix'], 10)
+    return slider_state(experiment)['marks']
 
 
 @app.callback(dash.dependencies.Output('theday-slider', 'value'),
               [dash.dependencies.Input('experiment-id', 'value')])
-def update_slider(experiment):
+def update_slider_value(experiment):
     ''' Updates the date sliders value '''
-    df = dataframe()
-    local_df = df[df['experimenttypename'] == experiment]
-    return [local_df['thedayunix'].min(), local_df['thedayunix'].max()]
+    return slider_state(experiment)['value']
 
 
-# caching filtered data for sharing
-@app.callback(dash.dependencies.Output('caching-in-browser', 'children'),
-              [dash.dependencies.Input('theday-slider', 'value'),
-               dash.dependencies.Input('device-dropdown', 'value'),
-               dash.dependencies.Input('experiment-id', 'value'),
-               dash.dependencies.Input('language-id', 'value'),
-               dash.dependencies.Input('channel-dropdown', 'value'),
-               dash.dependencies.Input('segment-dropdown', 'value')
-               ])
-def clean_data(date_range, isdesktop, experiment, language, channels, segments):
-    ''' Clean data based on all the dropdowns '''
-    df = dataframe()
-    start = time.time()
-    date_start = date_range[0]
-    date_end = date_range[1]
-    filtered_df = df[(df.thedayunix >= date_start) & (df.thedayunix <= date_end)]
-    filtered_df = filtered_df[filtered_df['isdesktop'] == isdesktop] if isdesktop is not None else filtered_df
-    filtered_df = filtered_df[filtered_df['experimenttypename'] == experiment] if experiment is not None else filtered_df
-    filtered_df = filtered_df[filtered_df['culturekey'].isin(language)] if language else filtered_df
-    filtered_df = filtered_df[filtered_df['channel'].isin(channels)] if channels else filtered_df
-    filtered_df = filtered_df[filtered_df['segment'].isin(segments)] if segments else filtered_df
+def filtered_data(filters, hourly=False):
+    '''
+    Returns the data filtered by the given filters, from the filtered data store if possible.
 
-    end = time.time()
-    print "recalculating data took {} seconds".format(end - start)
+    Args:
+        filters: a list with the date range, device, experiment, languages, channels and segments
+            exactly as passed to FilterIndex.select.
+        hourly: whether to filter the hourly cube instead of the daily one.
 
-    return filtered_df.to_json(orient = 'split')
+    The filtering runs through the index over the pre-aggregated cube rather than over the
+    raw rows, so the result has one row per cube cell. Since the callbacks of one interaction
+    can be served by different workers, a miss simply filters the cube again.
+    '''
+    current = snapshot()
+    key = result_key(current.version, filters, hourly)
+    index = current.derived['hourly_filter_index' if hourly else 'filter_index']
+    return cached('filtered_data', key, 'filter', lambda: index.select(*filters))
 
 
+def resolve_resolution(filters, resolution):
+    '''
+    Returns the resolution to plot the filtered data at.
 
+    'auto' picks the coarsest resolution with enough points over the days the filtered data
+    actually covers, and hours are only offered if the data has them.
+    '''
+    available = [r for r in RESOLUTIONS if r != 'hour' or snapshot().derived['hourly_cube'] is not None]
+    if resolution in available:
+        return resolution
+    days = filtered_data(filters)['thedayunix']
+    if not len(days):
+        return 'day'
+    return pick_resolution(days.min(), days.max(), available, RESOLUTION_MIN_POINTS)
 
-# metric scatter plot
-@app.callback(
-    dash.dependencies.Output('metrics-per-period', 'figure'),
-    [dash.dependencies.Input('caching-in-browser', 'children'),
-     dash.dependencies.Input('metric-dropdown', 'value')
-     ])
-def update_ratios_plot(cleaned_json_data, metric):
-    """ Callback for the "ratios" plot """
-    start = time.time()
-    local_df = pd.read_json(cleaned_json_data, orient='split')
-    end = time.time()
-    print "reading cached json for the metrics plot took {} seconds".format(end - start)
 
+def sequential_states(filters):
+    '''
+    Returns the monitored sequential states of the filtered experiment by arm, or None if there are none.
+
+    The monitor only has states per experiment and segment, so they are only used when no other
+    filter is set and the date range covers every day they have seen.
+    '''
+    date_range, isdesktop, experiment, language, channels, segments = filters
+    if experiment is None or isdesktop is not None or language or channels or (segments and len(segments) > 1):
+        return None
+    states = snapshot().derived['sequential'].arm_states(experiment, segments[0] if segments else ALL_SEGMENTS)
+    unix = lambda day: pd.Timestamp(day).value // 10**9
+    return dict((arm, state) for arm, state in states.items()
+                if len(state.days) and date_range[0] <= unix(state.days[0]) and unix(state.last_day) <= date_range[1])
+
+
+def daily_performance(filters, resolution='day'):
+    '''
+    Returns the performance.DailyPerformance of the data filtered by the given filters.
+
+    It holds the sums and ratios of every metric per period of the resolution, so both plots
+    and every metric of a filter combination share a single computation. The totals and their
+    bounds compare the days whatever the resolution, so they are the same at every one. The sequential
+    monitor only follows days, so the always valid bounds of other resolutions are computed
+    from the first period on.
+    '''
+    current = snapshot()
+    key = result_key('performance', current.version, filters, resolution)
+    states = sequential_states(filters) if resolution == 'day' else None
+    compute = lambda: DailyPerformance(filtered_data(filters, hourly=resolution == 'hour'),
+                                       period=RESOLUTIONS[resolution], confidence=CONFIDENCE,
+                                       resampler=resampler, sequential_states=states, tau2=SEQUENTIAL_TAU2)
+    return cached('performance', key, 'aggregate', compute)
+
+
+def figure_layout():
+    return {
+        'margin': {'l': 40, 'b': 40, 't': 10, 'r': 10},
+        'hovermode': 'closest'
+    }
+
+
+def scatter(x, y, **properties):
+    '''
+    Returns a plotly scatter trace as a plain dict, leaving out the properties that are None.
+
+    The traces are built straight from the precomputed frames, without plotly graph objects,
+    whose validation takes most of the time of building a figure.
+    '''
+    trace = {'type': 'scatter', 'x': np.asarray(x), 'y': np.asarray(y)}
+    for key, value in properties.items():
+        if isinstance(value, dict):
+            value = dict((k, v) for k, v in value.items() if v is not None) or None
+        if value is not None:
+            trace[key] = value
+    return trace
+
+
+def metrics_figure(performance, metric):
+    ''' Builds the figure with the daily sums of a metric per experiment mode '''
     traces = []
-    for i in local_df['experimentmodename'].unique():
-        df_by_experiment = local_df[local_df['experimentmodename'] == i]
-        grouped_df = df_by_experiment.groupby('theday').sum()[metric].reset_index()
-        traces.append(go.Scatter(
-            x = grouped_df['theday'],
-            y = grouped_df[metric],
-            name = i,
-            line = {'color': 'rgb(50,200,50)' if i == 'Regular' else None}
+    for name, days, values in performance.mode_series(metric):
+        traces.append(scatter(
+            x = days,
+            y = values,
+            name = name,
+            line = {'color': 'rgb(50,200,50)' if name == 'Regular' else None}
         ))
 
+    return {
+        'data': traces,
+        'layout': figure_layout()
+    }
 
 
-    end = time.time()
-    print "builinding the underlying objects for the metrics plot took {} seconds".format(end - start)
+def ratio_figure(performance, metric):
+    ''' Builds the figure with the ratios of a metric between every experiment arm and the regular track '''
+    arms = performance.arms
+    # the rolling average spans 7 periods of whatever resolution the plot has
+    period_name = dict((column, resolution) for resolution, column in RESOLUTIONS.items())[performance.period]
+    traces = []
+    for arm, arm_name in arms:
+        ratio_df = performance.ratio_frame(metric, arm)
+        for line in RATIO_LINES:
+            x = ratio_df['theday']
+            y = (ratio_df[line] - 1) * 100
+            mode = 'markers' if line == 'performance' else 'lines'
+            traces.append(scatter(
+                x = x,
+                y = y,
+                mode = mode,
+                # with several arms, every arm gets its own set of lines
+                name = (line if len(arms) == 1 else "{} {}".format(arm_name, line)).replace('7_day', '7_' + period_name),
+                text = ["p-value: {:.3g}".format(p) if np.isfinite(p) else "p-value: n/a"
+                        for p in ratio_df['total_performance_p_value']] if line == 'total_performance' else None,
+                line =  {
+                    'dash': "dot" if line.endswith('bound') else "solid",
+                    'color': 'rgb(50,200,50)' if 'total_performance' in line and len(arms) == 1 else
+                             'rgb(200,50,50)' if 'always_valid' in line and len(arms) == 1 else None
+                }
+            ))
 
     return {
         'data': traces,
-	'layoyt': go.Layout(
-            margin={'l': 40, 'b': 40, 't': 10, 'r': 10},
-            hovermode='closest'
-        )
+        'layout': figure_layout()
     }
 
 
-# ratios scatter plot
-@app.callback(
-    dash.dependencies.Output('ratio-per-period', 'figure'),
-    [dash.dependencies.Input('caching-in-browser', 'children'),
-     dash.dependencies.Input('metric-dropdown', 'value')
-     ])
-def update_metrics_plot(cleaned_json_data, metric):
-    """ Callback for the normal metrics plot """
-    start = time.time()
-    local_df = pd.read_json(cleaned_json_data, orient='split')
-    end = time.time()
-    print "reading cached json for the ratios plot took {} seconds".format(end - start)
-
-    num_unique_exp_modes = len(local_df['experimentmodeid'].unique())
-
-    # if there are more than 2 expeirment modes, we return an empty figure
-    if num_unique_exp_modes > 2:
-        return {
-            'data': [],
-            'layoyt': go.Layout(
-                margin={'l': 40, 'b': 40, 't': 10, 'r': 10},
-                hovermode='closest'
-            )
-        }
+FIGURE_BUILDERS = {
+    'metrics': metrics_figure,
+    'ratio': ratio_figure
+}
 
-    # otherwise, lets build the plot
 
-    regular_df = local_df[local_df['experimentmodeid'] == 1]\
-        .groupby('theday').sum()[metric].reset_index()\
-        .rename(index=str, columns={metric: "regular"})
+def figure(name, filters, metric, resolution):
+    ''' Returns the named figure for the filters, metric and resolution, built once per data version from the daily performance '''
+    current = snapshot()
+    resolution = resolve_resolution(filters, resolution)
+    key = result_key('figure', name, current.version, filters, metric, resolution)
+    return cached('figure', key, 'figure_' + name,
+                  lambda: FIGURE_BUILDERS[name](daily_performance(filters, resolution), metric))
 
-    experiment_df = local_df[local_df['experimentmodeid'] == 2]\
-        .groupby('theday').sum()[metric].reset_index()\
-        .rename(index=str, columns={metric: "experiment"})
 
-    ratio_df = regular_df.merge(experiment_df, on = 'theday')
+def request_filters(args):
+    '''
+    Returns the filters of an api request, as clean_data shares them with the plots.
 
+    The experiment is required. start and end are dates as YYYY-mm-dd or unix times and default
+    to the whole experiment, device is 0 for mobile or 1 for desktop, and language, channel and
+    segment can be given several times.
+    '''
+    extent = slider_state(args.get('experiment'))
+    if extent['min'] is None:
+        flask.abort(404, 'unknown experiment {}'.format(args.get('experiment')))
+    unix = lambda value: int(value) if value.isdigit() else pd.Timestamp(value).value // 10**9
+    try:
+        date_range = [unix(args['start']) if 'start' in args else extent['min'],
+                      unix(args['end']) if 'end' in args else extent['max']]
+        isdesktop = int(args['device']) if 'device' in args else None
+    except ValueError as e:
+        flask.abort(400, str(e))
+    if isdesktop not in (None, 0, 1):
+        flask.abort(400, 'device must be 0 or 1, not {}'.format(isdesktop))
+    return [date_range, isdesktop, args['experiment']] + \
+        [args.getlist(name) or None for name in ['language', 'channel', 'segment']]
+
+
+def api_etag(name):
+    '''
+    Returns the ETag of an api request and the snapshot serving it.
 
-    # calculate ratio metrics
-    ratio_df['performance'] = ratio_df["experiment"] / ratio_df["regular"]
-    ratio_df['7_day_average_performance'] = ratio_df['experiment'].rolling(7, min_periods = 7).sum() / ratio_df['regular'].rolling(7, min_periods = 1).sum()
+    The ETag is derived from the data version and the raw query string, so a request the
+    client already has is answered without parsing, filtering or resolving anything.
+    '''
+    current = snapshot()
+    query = sorted((key, sorted(values)) for key, values in flask.request.args.lists())
+    return result_key('payload', name, current.version, query), current
 
 
-    # try calculating a mean if there is enough data in both tracks
-    try:
-        mean = float(ratio_df["experiment"].sum()) / float(ratio_df["regular"].sum())
-    except ZeroDivisionError:
-        mean = 0
+@server.route('/api/v1/figures/<name>')
+def figure_api(name):
+    '''
+    Returns a figure of the dashboard as plotly JSON, for the filters in the query string, see request_filters.
 
-    ratio_df['total_performance'] = mean
+    The metric defaults to trial and the resolution to auto. The figure is shared with the
+    dash callbacks and encoded once per data version, see api_etag for revalidation.
+    '''
+    if name not in FIGURE_BUILDERS:
+        flask.abort(404, 'unknown figure {}'.format(name))
+    etag, current = api_etag(name)
+    response = not_modified(etag, current.version)
+    if response is not None:
+        return response
+
+    args = flask.request.args
+    metric = args.get('metric', 'trial')
+    if metric not in METRICS:
+        flask.abort(400, 'unknown metric {}'.format(metric))
+    filters = request_filters(args)
+    resolution = args.get('resolution', 'auto')
+    payload = cached('payload', etag, 'encode',
+                     lambda: EncodedPayload(figure(name, filters, metric, resolution), etag))
+    return payload_response(payload, current.version)
+
+
+def performance_summary(filters):
+    '''
+    Returns the comparison of the totals of every arm and metric of the filtered data, as a list of records.
 
+    The bounds and p-values of the ratios are the ones of the ratio plot, missing values are None.
+    '''
+    performance = daily_performance(filters)
+    summary = performance.totals.summary()
+    for column in ['ratio_lower', 'ratio_upper', 'p_value']:
+        summary[column] = performance.bounds[column].ravel()
+    summary = summary.astype(object).where(summary.notnull(), None)
+    return summary.to_dict('records')
+
+
+@server.route('/api/v1/summary')
+def summary_api():
+    ''' Returns the total comparison of every arm and metric as JSON, for the filters in the query string, see request_filters '''
+    etag, current = api_etag('summary')
+    response = not_modified(etag, current.version)
+    if response is None:
+        filters = request_filters(flask.request.args)
+        payload = cached('payload', etag, 'encode', lambda: EncodedPayload(performance_summary(filters), etag))
+        response = payload_response(payload, current.version)
+    return response
+
+
+# filters the data and shares the filters with the plots, the filtered data itself stays on the server
+@app.callback(dash.dependencies.Output('caching-in-browser', 'children'),
+              [dash.dependencies.Input('theday-slider', 'value'),
+               dash.dependencies.Input('device-dropdown', 'value'),
+               dash.dependencies.Input('experiment-id', 'value'),
+               dash.dependencies.Input('language-id', 'value'),
+               dash.dependencies.Input('channel-dropdown', 'value'),
+               dash.dependencies.Input('segment-dropdown', 'value')
+               ],
+              [dash.dependencies.State('resolution-dropdown', 'value')])
+def clean_data(date_range, isdesktop, experiment, language, channels, segments, resolution):
+    ''' Clean data based on all the dropdowns '''
+    filters = [date_range, isdesktop, experiment, language, channels, segments]
+    # computes every metric up front, so the plots and later metric switches are lookups
+    daily_performance(filters, resolve_resolution(filters, resolution))
 
-    # try calculating the error 4 sigmas above and below, if there is enough data as well
-    try:
-        error = 4 / math.sqrt(ratio_df["regular"].sum())
-    except ZeroDivisionError:
-        error = 0
-    ratio_df['total_performance_upperbound'] = ratio_df['total_performance'] + error
-    ratio_df['total_performance_lowerbound'] = ratio_df['total_performance'] - error
+    return json.dumps(filters)
 
 
-    # build the figure
-    traces = []
 
-    lines = ['performance', '7_day_average_performance', 'total_performance', 'total_performance_upperbound', 'total_performance_lowerbound' ]
-    for line in lines:
-        x = ratio_df['theday']
-        y = (ratio_df[line] - 1) * 100
-        mode = 'markers' if line == 'performance' else 'lines'
-        traces.append(go.Scatter(
-            x = x,
-            y = y,
-            mode = mode,
-            name = line,
-            line =  {
-                'dash': "dot" if line == "total_performance_upperbound" or line == "total_performance_lowerbound" else "solid",
-                'color': 'rgb(50,200,50)' if 'total_performance' in line else None
-            }
-        ))
 
-    end = time.time()
-    print "builinding the underlying objects for the ratio plot took {} seconds".format(end - start)
+# metric scatter plot
+@app.callback(
+    dash.dependencies.Output('metrics-per-period', 'figure'),
+    [dash.dependencies.Input('caching-in-browser', 'children'),
+     dash.dependencies.Input('metric-dropdown', 'value'),
+     dash.dependencies.Input('resolution-dropdown', 'value')
+     ])
+def update_ratios_plot(cleaned_filters, metric, resolution):
+    """ Callback for the "ratios" plot """
+    return figure('metrics', json.loads(cleaned_filters), metric, resolution)
 
 
-    return {
-        'data': traces,
-	'layoyt': go.Layout(
-            margin={'l': 40, 'b': 40, 't': 10, 'r': 10},
-            hovermode='closest'
-        )
-    }
+# ratios scatter plot
+@app.callback(
+    dash.dependencies.Output('ratio-per-period', 'figure'),
+    [dash.dependencies.Input('caching-in-browser', 'children'),
+     dash.dependencies.Input('metric-dropdown', 'value'),
+     dash.dependencies.Input('resolution-dropdown', 'value')
+     ])
+def update_metrics_plot(cleaned_filters, metric, resolution):
+    """ Callback for the normal metrics plot """
+    return figure('ratio', json.loads(cleaned_filters), metric, resolution)
 
 
 
@@ -458,5 +696,5 @@ def update_metrics_plot(cleaned_json_data, metric):
 
 
 if __name__ == '__main__':
-    cache.delete_memoized(load_data)
+    snapshots.clear()
     app.run_server(debug = True) # use to run locally    
@@ -0,0 +1,382 @@
+"""
+Load test of the dash callback chain with concurrent simulated users.
+
+The app is started with gunicorn against a synthetic dataset (see synthetic.py), and every
+simulated user replays what an analyst does in the browser, as requests to
+/_dash-update-component:
+    switch_experiment: the description and the four slider callbacks, then clean_data over the
+        whole experiment and both plots.
+    drag_slider: clean_data over a new date range and both plots.
+    change_filters: clean_data with new device, language, channel and segment selections and
+        both plots.
+    switch_metric: both plots for another metric.
+A user sends its callbacks one after the other and starts the next action as soon as the last
+one returns, plus an optional think time, so the load grows with the number of users.
+
+Every concurrency level runs for a fixed time and reports the p50, p95 and p99 latency of
+every callback and of every action, the throughput and the errors. The resident memory of
+every gunicorn worker is sampled during the run and reported at the start and end of every
+level with its peak, to see caches grow with the users. The results are written as JSON.
+
+Usage, from the repository root:
+    python benchmarks/load_test.py --rows 1000000 --users 1 4 16 --duration 60 --workers 3
+    python benchmarks/load_test.py --worker_class gthread --threads 4 --users 16
+    python benchmarks/load_test.py --url http://localhost:8000 --data_dir /tmp/bench --users 8
+The last one targets an app that is already running on the data in /tmp/bench, without
+measuring its memory.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import requests
+
+import synthetic
+from run import REPO, commit
+from cube import METRICS
+
+
+DASH_UPDATE = '/_dash-update-component'
+
+# how often every action is picked, the experiment is switched the least
+ACTION_WEIGHTS = [('switch_experiment', 1), ('drag_slider', 3), ('change_filters', 3), ('switch_metric', 3)]
+
+
+def latency_summary(latencies):
+    """ Returns the count and the mean, p50, p95, p99 and max of a list of durations in seconds """
+    latencies = np.array(latencies)
+    if not len(latencies):
+        return {'count': 0}
+    return {'count': len(latencies), 'mean': latencies.mean(), 'p50': np.percentile(latencies, 50),
+            'p95': np.percentile(latencies, 95), 'p99': np.percentile(latencies, 99), 'max': latencies.max()}
+
+
+def dataset_options(df):
+    """ Returns the dropdown values and the unix day range of every experiment of a synthetic dataset """
+    days = pd.to_datetime(df['theday']).astype(np.int64) // 10**9
+    extents = days.groupby(df['experimenttypename']).agg(['min', 'max'])
+    return {'experiments': dict((experiment, [int(row['min']), int(row['max'])]) for experiment, row in extents.iterrows()),
+            'languages': sorted(df['culturekey'].unique()),
+            'channels': sorted(df['channel'].unique()),
+            'segments': sorted(df['segment'].unique())}
+
+
+class SimulatedUser:
+    """
+    One analyst clicking through the dashboard, replaying its callbacks against a running app.
+
+    Args:
+        url: the root url of the app.
+        options: the dropdown values and experiment day ranges, see dataset_options.
+        seed: the seed of the user's choices.
+        think: the seconds to wait between two actions.
+    """
+
+    def __init__(self, url, options, seed, think = 0):
+        self.url = url
+        self.options = options
+        self.rng = random.Random(seed)
+        self.think = think
+        self.session = requests.Session()
+        self.requests = []
+        self.actions = []
+        self.errors = 0
+        self.metric = 'trial'
+        self.resolution = 'auto'
+        self.isdesktop = None
+        self.languages = self.channels = self.segments = None
+        self.experiment = None
+        self.date_range = None
+        self.cleaned = None
+
+    def callback(self, output, inputs, state = ()):
+        """ Sends one callback request and returns the new value of its output, or None if it failed """
+        component, prop = output.split('.')
+        body = {'output': {'id': component, 'property': prop},
+                'inputs': [{'id': i.split('.')[0], 'property': i.split('.')[1], 'value': v} for i, v in inputs],
+                'state': [{'id': s.split('.')[0], 'property': s.split('.')[1], 'value': v} for s, v in state]}
+        start = time.time()
+        try:
+            response = self.session.post(self.url + DASH_UPDATE, json = body, timeout = 300)
+            ok = response.status_code == 200
+            size = len(response.content)
+        except requests.RequestException:
+            ok, size = False, 0
+        self.requests.append((output, time.time() - start, ok, size))
+        if not ok:
+            self.errors += 1
+            return None
+        return response.json()['response']['props'][prop]
+
+    def clean_data_and_plots(self):
+        """ Sends clean_data for the current selections and then both plot callbacks """
+        cleaned = self.callback('caching-in-browser.children',
+                                [('theday-slider.value', self.date_range), ('device-dropdown.value', self.isdesktop),
+                                 ('experiment-id.value', self.experiment), ('language-id.value', self.languages),
+                                 ('channel-dropdown.value', self.channels), ('segment-dropdown.value', self.segments)],
+                                [('resolution-dropdown.value', self.resolution)])
+        if cleaned is not None:
+            self.plots(cleaned)
+
+    def plots(self, cleaned):
+        """ Sends both plot callbacks for the cleaned filters """
+        self.cleaned = cleaned
+        inputs = [('caching-in-browser.children', cleaned), ('metric-dropdown.value', self.metric),
+                  ('resolution-dropdown.value', self.resolution)]
+        self.callback('metrics-per-period.figure', inputs)
+        self.callback('ratio-per-period.figure', inputs)
+
+    def subset(self, values):
+        """ Returns None, as an empty multi-select, or a few of the values """
+        return self.rng.sample(values, self.rng.randint(1, min(2, len(values)))) if self.rng.random() < 0.5 else None
+
+    def switch_experiment(self):
+        self.experiment = self.rng.choice(sorted(self.options['experiments']))
+        for output in ['experiment-description.children', 'theday-slider.min', 'theday-slider.max',
+                       'theday-slider.marks', 'theday-slider.value']:
+            value = self.callback(output, [('experiment-id.value', self.experiment)])
+        self.date_range = value or self.options['experiments'][self.experiment]
+        self.clean_data_and_plots()
+
+    def drag_slider(self):
+        first, last = self.options['experiments'][self.experiment]
+        days = range(first, last + 1, 86400)
+        start = self.rng.choice(days)
+        self.date_range = [start, self.rng.choice([day for day in days if day >= start])]
+        self.clean_data_and_plots()
+
+    def change_filters(self):
+        self.isdesktop = self.rng.choice([None, 0, 1])
+        self.languages = self.subset(self.options['languages'])
+        self.channels = self.subset(self.options['channels'])
+        self.segments = self.subset(self.options['segments'])
+        self.clean_data_and_plots()
+
+    def switch_metric(self):
+        self.metric = self.rng.choice([metric for metric in METRICS if metric != self.metric])
+        self.plots(self.cleaned)
+
+    def run(self, until):
+        """ Replays random actions until the unix time until, starting with an experiment switch """
+        action = 'switch_experiment'
+        while time.time() < until:
+            start = time.time()
+            getattr(self, action)()
+            self.actions.append((action, time.time() - start))
+            if self.think:
+                time.sleep(self.think)
+            # the metric can only be switched once some filters were cleaned
+            action = weighted_choice(self.rng, ACTION_WEIGHTS) if self.cleaned is not None else 'switch_experiment'
+
+
+def weighted_choice(rng, weights):
+    """ Returns one of the names of (name, weight) pairs, with a probability proportional to its weight """
+    point = rng.uniform(0, sum(weight for _, weight in weights))
+    for name, weight in weights:
+        point -= weight
+        if point <= 0:
+            return name
+    return weights[-1][0]
+
+
+def worker_pids(master_pid):
+    """ Returns the pids of the processes whose parent is master_pid, the gunicorn workers """
+    pids = []
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            stat = open('/proc/{}/stat'.format(pid)).read()
+        except IOError:
+            continue
+        # the fields after the command, which is in parentheses, are the state and the parent pid
+        if int(stat.rsplit(')', 1)[1].split()[1]) == master_pid:
+            pids.append(int(pid))
+    return sorted(pids)
+
+
+def resident_mb(pid):
+    """ Returns the resident memory of a process in MB, or None if it is gone """
+    try:
+        for line in open('/proc/{}/status'.format(pid)):
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.
+    except IOError:
+        return None
+
+
+class MemorySampler(threading.Thread):
+    """
+    Samples the resident memory of the gunicorn workers in the background.
+
+    Args:
+        master_pid: the pid of the gunicorn master, or None to sample nothing.
+        interval: the seconds between two samples.
+    """
+
+    def __init__(self, master_pid, interval = 0.5):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.master_pid = master_pid
+        self.interval = interval
+        self.samples = defaultdict(list)
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        """ Records and returns the memory of every worker, by pid """
+        memory = {}
+        for pid in worker_pids(self.master_pid) if self.master_pid else []:
+            memory[pid] = resident_mb(pid)
+            if memory[pid] is not None:
+                self.samples[pid].append(memory[pid])
+        return memory
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        """ Stops sampling and returns the first, last and peak memory of every worker, in MB """
+        self._stop_event.set()
+        self.join()
+        self.sample()
+        return dict((str(pid), {'start': values[0], 'end': values[-1], 'peak': max(values)})
+                    for pid, values in self.samples.items())
+
+
+def run_level(url, options, users, duration, think, seed, master_pid):
+    """ Runs users simulated users for duration seconds and returns the latencies, throughput and memory """
+    sampler = MemorySampler(master_pid)
+    sampler.sample()
+    sampler.start()
+
+    simulated = [SimulatedUser(url, options, seed * 1000 + i, think) for i in range(users)]
+    start = time.time()
+    threads = [threading.Thread(target = user.run, args = (start + duration,)) for user in simulated]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    request_log = [entry for user in simulated for entry in user.requests]
+    action_log = [entry for user in simulated for entry in user.actions]
+    by_output, by_action = defaultdict(list), defaultdict(list)
+    for output, seconds, ok, size in request_log:
+        if ok:
+            by_output[output].append(seconds)
+    for action, seconds in action_log:
+        by_action[action].append(seconds)
+
+    return {'users': users, 'seconds': elapsed,
+            'requests': len(request_log), 'errors': sum(user.errors for user in simulated),
+            'requests_per_second': len(request_log) / elapsed, 'actions_per_second': len(action_log) / elapsed,
+            'response_bytes': sum(size for _, _, _, size in request_log),
+            'latency': latency_summary([seconds for _, seconds, ok, _ in request_log if ok]),
+            'callbacks': dict((output, latency_summary(values)) for output, values in by_output.items()),
+            'actions': dict((action, latency_summary(values)) for action, values in by_action.items()),
+            'worker_memory_mb': sampler.stop()}
+
+
+def start_server(paths, port, workers, worker_class, threads, gunicorn_args):
+    """ Starts the app with gunicorn on the synthetic dataset and returns the process once it answers """
+    env = dict(os.environ, CSV_LOCATION = paths['csv'], EXP_PARAMS_PATH = paths['config'],
+               CACHE_FOLDER = os.path.join(os.path.dirname(paths['csv']), 'cache'))
+    command = [sys.executable, '-m', 'gunicorn.app.wsgiapp', '-w', str(workers), '-k', worker_class,
+               '--threads', str(threads), '-b', '127.0.0.1:{}'.format(port), '--timeout', '600'] + \
+        gunicorn_args + ['app:server']
+    server = subprocess.Popen(command, cwd = REPO, env = env)
+
+    url = 'http://127.0.0.1:{}'.format(port)
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('gunicorn exited with code {}'.format(server.returncode))
+        try:
+            if requests.get(url + '/_dash-layout', timeout = 5).status_code == 200:
+                return server, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError('the app did not answer within 120 seconds')
+
+
+def main(**kwargs):
+    scale = synthetic.scale(argparse.Namespace(**kwargs))
+    folder = kwargs['data_dir'] or tempfile.mkdtemp(prefix = 'experiments-load-test-')
+    server = None
+    try:
+        paths = {'csv': os.path.join(folder, 'data.csv'), 'config': os.path.join(folder, 'experiment_config.yaml')}
+        if not os.path.exists(paths['csv']):
+            paths = synthetic.write_dataset(synthetic.generate_rows(**scale), folder)
+        options = dataset_options(pd.read_csv(paths['csv'], usecols = ['experimenttypename', 'theday', 'culturekey',
+                                                                       'channel', 'segment']))
+
+        url = kwargs['url']
+        if not url:
+            server, url = start_server(paths, kwargs['port'], kwargs['workers'], kwargs['worker_class'],
+                                       kwargs['threads'], (kwargs['gunicorn_args'] or '').split())
+        master_pid = server.pid if server else None
+
+        # loads the data in every worker and fills some caches, without recording anything
+        if kwargs['warmup']:
+            run_level(url, options, kwargs['users'][0], kwargs['warmup'], kwargs['think'], -1, None)
+
+        levels = []
+        for i, users in enumerate(kwargs['users']):
+            level = run_level(url, options, users, kwargs['duration'], kwargs['think'], kwargs['seed'] + i, master_pid)
+            levels.append(level)
+            latency = level['latency']
+            print "{} users: {:.1f} requests/s, p50 {:.3f}s, p95 {:.3f}s, p99 {:.3f}s, {} errors".format(
+                users, level['requests_per_second'], latency.get('p50', np.nan), latency.get('p95', np.nan),
+                latency.get('p99', np.nan), level['errors'])
+    finally:
+        if server is not None:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+        if not kwargs['data_dir']:
+            shutil.rmtree(folder, ignore_errors = True)
+
+    results = {'commit': commit(), 'created': datetime.datetime.utcnow().isoformat(), 'scale': scale,
+               'server': {'url': kwargs['url'], 'workers': kwargs['workers'], 'worker_class': kwargs['worker_class'],
+                          'threads': kwargs['threads'], 'gunicorn_args': kwargs['gunicorn_args']},
+               'duration': kwargs['duration'], 'think': kwargs['think'], 'levels': levels}
+    output = json.dumps(results, indent = 2, sort_keys = True)
+    if kwargs['output_path']:
+        with open(kwargs['output_path'], 'w') as output_file:
+            output_file.write(output)
+    else:
+        print output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Load tests the dash callbacks with concurrent simulated users, writing the latencies, throughput and worker memory as JSON")
+    synthetic.add_scale_arguments(parser)
+    parser.add_argument('-u', '--users', type = int, nargs = '+', default = [1, 4, 16],
+                        help = 'the numbers of concurrent users to run, one level after the other')
+    parser.add_argument('-t', '--duration', type = float, default = 30, help = 'seconds every level runs')
+    parser.add_argument('--think', type = float, default = 0, help = 'seconds every user waits between two actions')
+    parser.add_argument('--warmup', type = float, default = 10,
+                        help = 'seconds of unrecorded load before the first level, 0 measures the cold start as well')
+    parser.add_argument('-w', '--workers', type = int, default = 3, help = 'number of gunicorn workers, as in the Dockerfile')
+    parser.add_argument('-k', '--worker_class', default = 'sync', help = 'gunicorn worker class, such as sync or gthread')
+    parser.add_argument('--threads', type = int, default = 1, help = 'threads per gunicorn worker, for the gthread class')
+    parser.add_argument('--gunicorn_args', help = 'any other gunicorn arguments, as one string')
+    parser.add_argument('--port', type = int, default = 8050, help = 'port to start the app on')
+    parser.add_argument('--url', help = 'root url of an app that is already running, on the dataset in --data_dir')
+    parser.add_argument('-o', '--output_path', help = 'file to write the JSON results to, they are printed otherwise')
+    parser.add_argument('-d', '--data_dir', help = 'folder with the dataset, generated there if missing, a temporary one by default')
+    main(**vars(parser.parse_args()))
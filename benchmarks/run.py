@@ -0,0 +1,190 @@
+"""
+Benchmarks of the data extraction and of the dashboard hot paths on synthetic data.
+
+A synthetic dataset is generated at the requested scale (see synthetic.py) and every
+scenario is timed a number of times:
+    extract, extract_parallel, extract_pushdown: DataExtractor against the SQLite table.
+    cold_start: loading the csv and building the cube, indexes and the rest per data version.
+    worker_start: picking up the snapshot on disk, like a worker started after the first one.
+    refresh: a scheduled refresh while the current data keeps being served.
+    filter_change: a new filter combination, through clean_data and both plot callbacks.
+    metric_switch: another metric for the same filters, through both plot callbacks.
+
+The results are written as JSON with the commit, the scale and the min, mean, p50, p95 and
+max seconds of every scenario, so runs of different commits can be compared.
+
+Usage, from the repository root:
+    python benchmarks/run.py --rows 1000000 --experiments 4 --days 60 -o results.json
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import yaml
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import synthetic
+from cube import METRICS
+from data_extractor import DataExtractor
+
+
+class SQLiteExtractor(DataExtractor):
+    """ DataExtractor reading the synthetic table from a SQLite database instead of Redshift """
+
+    database = None
+
+    def connect(self):
+        return sqlite3.connect(self.database, check_same_thread = False)
+
+
+def summarize(times):
+    """ Returns the number of runs and the min, mean, p50, p95 and max of a list of durations """
+    times = np.array(times)
+    return {'runs': len(times), 'min': times.min(), 'mean': times.mean(), 'p50': np.percentile(times, 50),
+            'p95': np.percentile(times, 95), 'max': times.max()}
+
+
+def timed(run, repeats, before = None):
+    """ Times repeats calls of run, calling before untimed ahead of each one """
+    times = []
+    for i in range(repeats):
+        if before:
+            before(i)
+        start = time.time()
+        run(i)
+        times.append(time.time() - start)
+    return summarize(times)
+
+
+def commit():
+    """ Returns the checked out commit, or None outside of a git checkout """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = REPO).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def extraction_scenarios(paths, repeats):
+    """ Times the extraction of the synthetic table through DataExtractor """
+    SQLiteExtractor.database = paths['sqlite']
+    config = yaml.safe_load(open(paths['config']))
+    base_query = os.path.join(REPO, 'sql', 'base_sql_grouped.sql')
+    variants = [('extract', {}),
+                ('extract_parallel', {'parallelism': 4}),
+                ('extract_pushdown', {'pushdown': True})]
+    return dict((name, timed(lambda i: SQLiteExtractor(config, base_query, **options), repeats))
+                for name, options in variants)
+
+
+def random_filters(app, rng):
+    """ Returns a random filter combination of the dashboard, as clean_data takes it """
+    index = app.dimension_index()
+    experiment = rng.choice(index['experimenttypename'])
+    extent = app.slider_state(experiment)
+    days = range(extent['min'], extent['max'] + 1, 86400)
+    start = rng.choice(days[:max(1, len(days) // 2)])
+    subset = lambda values: rng.sample(values, rng.randint(0, min(2, len(values)))) or None
+    return [[start, extent['max']], rng.choice([None, 0, 1]), experiment,
+            subset(index['culturekey']), subset(index['channel']), subset(index['segment'])]
+
+
+def app_scenarios(paths, repeats, seed):
+    """ Times the dashboard hot paths, importing the app against the synthetic csv """
+    os.environ['CSV_LOCATION'] = paths['csv']
+    os.environ['EXP_PARAMS_PATH'] = paths['config']
+    os.environ['CACHE_FOLDER'] = os.path.join(os.path.dirname(paths['csv']), 'cache')
+    os.chdir(REPO)
+
+    results = {}
+    start = time.time()
+    import app
+    results['import'] = summarize([time.time() - start])
+    # the scheduler warms the data store up in the background on import, which would make the
+    # first cold start warm. Its run is waited for, and every cold start forgets it
+    app.refresh_scheduler.stop(timeout = None)
+
+    def cold(i):
+        # forgets every loaded, saved and derived version of the data
+        app.data_store.snapshot = None
+        app.snapshots.clear()
+        app.filtered_data_store.clear()
+        app.sequential_monitor = app.SequentialMonitor(alpha = 1 - app.CONFIDENCE, tau2 = app.SEQUENTIAL_TAU2)
+    results['cold_start'] = timed(lambda i: app.snapshot(), repeats, before = cold)
+
+    def new_worker(i):
+        app.data_store.snapshot = None
+        app.filtered_data_store.clear()
+    results['worker_start'] = timed(lambda i: app.snapshot(), repeats, before = new_worker)
+
+    exp_params = app.read_exp_params()
+    results['refresh'] = timed(lambda i: app.data_store.refresh(exp_params, lambda: app.load_data(exp_params),
+                                                                newer_than = time.time()), repeats)
+
+    rng = random.Random(seed)
+    combinations = [random_filters(app, rng) for _ in range(repeats)]
+
+    def change_filters(i):
+        filters = app.clean_data(*(combinations[i] + ['auto']))
+        cleaned = json.loads(filters.get_data())['response']['props']['children']
+        app.update_ratios_plot(cleaned, 'trial', 'auto')
+        app.update_metrics_plot(cleaned, 'trial', 'auto')
+    results['filter_change'] = timed(change_filters, repeats, before = lambda i: app.filtered_data_store.clear())
+
+    cleaned = json.dumps(combinations[0])
+    app.clean_data(*(combinations[0] + ['auto']))
+    metrics = [METRICS[i % len(METRICS)] for i in range(1, repeats + 1)]
+
+    def switch_metric(i):
+        app.update_ratios_plot(cleaned, metrics[i], 'auto')
+        app.update_metrics_plot(cleaned, metrics[i], 'auto')
+    results['metric_switch'] = timed(switch_metric, repeats)
+
+    return results
+
+
+def main(**kwargs):
+    scale = synthetic.scale(argparse.Namespace(**kwargs))
+    folder = kwargs['data_dir'] or tempfile.mkdtemp(prefix = 'experiments-benchmark-')
+    try:
+        start = time.time()
+        df = synthetic.generate_rows(**scale)
+        paths = synthetic.write_dataset(df, folder)
+        scenarios = {'generate': summarize([time.time() - start])}
+
+        if not kwargs['skip_extract']:
+            scenarios.update(extraction_scenarios(paths, kwargs['repeats']))
+        if not kwargs['skip_app']:
+            scenarios.update(app_scenarios(paths, kwargs['repeats'], kwargs['seed']))
+    finally:
+        if not kwargs['data_dir']:
+            shutil.rmtree(folder, ignore_errors = True)
+
+    results = {'commit': commit(), 'created': datetime.datetime.utcnow().isoformat(), 'scale': scale,
+               'repeats': kwargs['repeats'], 'scenarios': scenarios}
+    output = json.dumps(results, indent = 2, sort_keys = True)
+    if kwargs['output_path']:
+        with open(kwargs['output_path'], 'w') as output_file:
+            output_file.write(output)
+    print output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmarks the extraction and the dashboard on synthetic data, writing the timings as JSON")
+    synthetic.add_scale_arguments(parser)
+    parser.add_argument('-r', '--repeats', type = int, default = 5, help = 'how many times every scenario runs')
+    parser.add_argument('-o', '--output_path', help = 'file to write the JSON results to, they are always printed')
+    parser.add_argument('-d', '--data_dir', help = 'folder to keep the generated dataset in, a temporary one by default')
+    parser.add_argument('--skip_extract', action = 'store_true', help = 'skip the DataExtractor scenarios')
+    parser.add_argument('--skip_app', action = 'store_true', help = 'skip the dashboard scenarios')
+    main(**vars(parser.parse_args()))
@@ -0,0 +1,145 @@
+"""
+Synthetic experiment data with the schema of gtemp_experimentdashboard.
+
+The rows have the columns selected by sql/base_sql.sql plus the channel, segment and thehour
+columns of the dashboard table, one row per trial customer. Every experiment runs for its own
+block of consecutive days and splits its customers evenly over its arms, the first one being
+the Regular arm. The metrics are drawn as 0/1 flags with fixed base rates, and every arm after
+the first converts a little better.
+
+Usage:
+    python benchmarks/synthetic.py -o /tmp/bench --rows 1000000 --experiments 4 --days 60
+writes data.csv, a SQLite database with the gtemp_experimentdashboard table and the matching
+experiment_config.yaml to /tmp/bench.
+"""
+import argparse
+import datetime
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import yaml
+
+
+TABLE = 'gtemp_experimentdashboard'
+
+# the share of trials with each metric in the Regular arm
+BASE_RATES = [('sco30m', 0.4), ('completedcheckout30m', 0.1), ('qp6h', 0.05), ('paid', 0.08), ('edit30m', 0.6),
+              ('w1return', 0.3), ('lowqualret', 0.15), ('medqualret', 0.1), ('highqualret', 0.05)]
+
+CHANNELS = ['seo', 'sem', 'direct', 'referral', 'social', 'email', 'display', 'affiliate']
+
+
+def generate_rows(experiments = 2, arms = 2, days = 14, languages = 10, channels = 4, segments = 3,
+                  rows = 100000, lift = 0.05, start = '2018-01-01', seed = 0):
+    """
+    Returns a data frame of synthetic dashboard rows, one per trial customer.
+
+    Args:
+        experiments: the number of experiments, named exp1, exp2...
+        arms: the number of arms of every experiment, including the Regular one.
+        days: the number of days every experiment runs, one experiment after the other.
+        languages: the number of distinct culture keys.
+        channels: the number of distinct channels.
+        segments: the number of distinct segments.
+        rows: the total number of rows.
+        lift: the relative increase of every metric rate from one arm to the next.
+        start: the first day of the first experiment.
+        seed: the seed of the draws.
+    """
+    random = np.random.RandomState(seed)
+    experiment = random.randint(0, experiments, rows)
+    arm = random.randint(0, arms, rows)
+    day = experiment * days + random.randint(0, days, rows)
+    hour = random.randint(0, 24, rows)
+
+    first_day = pd.Timestamp(start)
+    hours = first_day + pd.to_timedelta(day * 24 + hour, unit = 'h')
+    mode_names = np.array(['Regular'] + ['Experiment'] + ['Experiment {}'.format(i) for i in range(2, arms)])[:arms]
+    culture_keys = np.array(['lang{:02d}-XX'.format(i) for i in range(languages)])
+    channel_names = np.array((CHANNELS + ['channel{}'.format(i) for i in range(len(CHANNELS), channels)])[:channels])
+    segment_names = np.array([chr(ord('a') + i) if i < 26 else 'segment{}'.format(i) for i in range(segments)])
+
+    df = pd.DataFrame({
+        'experimenttypename': np.char.add('exp', (experiment + 1).astype(str)),
+        'experimentmodename': mode_names[arm],
+        'experimentmodeid': arm + 1,
+        'isdesktop': random.randint(0, 2, rows),
+        # a few languages, channels and segments take most of the traffic, like the real ones
+        'culturekey': culture_keys[np.minimum(random.geometric(0.3, rows) - 1, languages - 1)],
+        'channel': channel_names[np.minimum(random.geometric(0.4, rows) - 1, channels - 1)],
+        'segment': segment_names[random.randint(0, segments, rows)],
+        'theday': hours.strftime('%Y-%m-%d'),
+        'thehour': hours.strftime('%Y-%m-%d %H:00:00'),
+        'trial': np.ones(rows, dtype = int)
+    })
+    for metric, rate in BASE_RATES:
+        df[metric] = (random.rand(rows) < rate * (1 + lift) ** arm).astype(int)
+    return df
+
+
+def experiment_config(df):
+    """ Returns the experiment configuration covering the days of every experiment in df """
+    config = {}
+    for experiment, days in df.groupby('experimenttypename')['theday']:
+        config[experiment] = {'dates': [days.min(), days.max()], 'description': 'synthetic experiment {}'.format(experiment)}
+    return config
+
+
+def write_sqlite(df, path, table = TABLE):
+    """ Writes df to a SQLite database as the dashboard table, replacing it if it exists """
+    conn = sqlite3.connect(path)
+    try:
+        df.to_sql(table, conn, index = False, if_exists = 'replace')
+        conn.execute("create index if not exists {0}_theday on {0} (experimenttypename, theday)".format(table))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def write_dataset(df, folder):
+    """
+    Writes df to folder as data.csv, data.sqlite and experiment_config.yaml.
+
+    returns:
+        a dictionary with the paths of the csv, the database and the experiment configuration.
+    """
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    paths = {'csv': os.path.join(folder, 'data.csv'),
+             'sqlite': os.path.join(folder, 'data.sqlite'),
+             'config': os.path.join(folder, 'experiment_config.yaml')}
+    df.to_csv(paths['csv'], index = False)
+    write_sqlite(df, paths['sqlite'])
+    with open(paths['config'], 'w') as config_file:
+        yaml.safe_dump(experiment_config(df), config_file, default_flow_style = False)
+    return paths
+
+
+def add_scale_arguments(parser):
+    """ Adds the arguments of generate_rows to an argparse parser """
+    parser.add_argument('--experiments', type = int, default = 2, help = 'number of experiments')
+    parser.add_argument('--arms', type = int, default = 2, help = 'number of arms per experiment, including the regular one')
+    parser.add_argument('--days', type = int, default = 14, help = 'number of days every experiment runs')
+    parser.add_argument('--languages', type = int, default = 10, help = 'number of culture keys')
+    parser.add_argument('--channels', type = int, default = 4, help = 'number of channels')
+    parser.add_argument('--segments', type = int, default = 3, help = 'number of segments')
+    parser.add_argument('--rows', type = int, default = 100000, help = 'number of rows, one per trial')
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed of the generated data')
+
+
+def scale(args):
+    """ Returns the generate_rows arguments of parsed arguments """
+    return dict((name, getattr(args, name))
+                for name in ['experiments', 'arms', 'days', 'languages', 'channels', 'segments', 'rows', 'seed'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Generates synthetic experiment data as a csv, a SQLite table and an experiment config")
+    parser.add_argument('-o', '--output_dir', required = True, help = 'folder to write the dataset to')
+    add_scale_arguments(parser)
+    args = parser.parse_args()
+    start = datetime.datetime.now()
+    print write_dataset(generate_rows(**scale(args)), args.output_dir)
+    print "generating the data took {} seconds".format((datetime.datetime.now() - start).total_seconds())
@@ -0,0 +1,119 @@
+import Queue
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+
+class ConnectionPool:
+    """
+    A bounded, thread safe pool of reusable DB connections.
+
+    Connections are created lazily with the given connect function, so the pool works with
+    any DB-API connection (psycopg2 for Redshift, sqlite3 or a local PostgreSQL for testing).
+    At most size connections exist at the same time, and threads asking for a connection
+    while all of them are in use block until one is released. The pool also keeps the threads
+that map runs on, so a long lived pool reuses both across extractions.
+
+    Connections can sit idle for a long time between extractions, and the server or a NAT
+    timeout may drop them meanwhile. A connection idle for more than ping_after seconds is
+    checked with SELECT 1 before it is handed out, and replaced if it does not answer.
+
+    Args:
+        connect: a function without arguments that returns a new connection.
+        size: the maximum number of connections.
+        ping_after: the seconds a connection can be idle before it is checked on checkout.
+    """
+
+    def __init__(self, connect, size, ping_after = 60):
+        self.connect = connect
+        self.size = size
+        self.ping_after = ping_after
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._workers = None
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Returns a live idle connection, or a new one if there is none and the pool is not full """
+        self._slots.acquire()
+        while True:
+            try:
+                conn, released_at = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            if time.time() - released_at <= self.ping_after or is_alive(conn):
+                return conn
+            close_quietly(conn)
+        try:
+            return self.connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn, broken = False):
+        """ Gives a connection back to the pool, closing it instead if it is broken """
+        if broken:
+            close_quietly(conn)
+        else:
+            self._idle.put((conn, time.time()))
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """ Context manager that acquires a connection and releases it afterwards """
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception:
+            self.release(conn, broken = True)
+            raise
+        self.release(conn)
+
+    def map(self, function, items):
+        """ Calls function(conn, item) for every item on up to size threads, each with a pooled connection, and returns the results in order """
+        with self._lock:
+            if self._workers is None:
+                self._workers = ThreadPool(self.size)
+            workers = self._workers
+
+        def run(item):
+            with self.connection() as conn:
+                return function(conn, item)
+        return workers.map(run, items)
+
+    def close(self):
+        """ Closes every idle connection and stops the threads """
+        with self._lock:
+            if self._workers is not None:
+                self._workers.close()
+                self._workers = None
+        while True:
+            try:
+                self._idle.get_nowait()[0].close()
+            except Queue.Empty:
+                return
+
+
+def is_alive(conn):
+    """ Whether a connection is open and answers SELECT 1 """
+    if getattr(conn, 'closed', False):
+        return False
+    try:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('select 1')
+            cursor.fetchall()
+        finally:
+            cursor.close()
+    except Exception:
+        return False
+    return True
+
+
+def close_quietly(conn):
+    """ Closes a connection that may already be broken, ignoring errors """
+    try:
+        conn.close()
+    except Exception:
+        pass
@@ -0,0 +1,89 @@
+"""
+Pre-aggregation of the dashboard data.
+
+The raw data has a row per customer (or per small group of customers), so it grows with
+traffic. Every question the dashboard asks is a sum of metrics over some filter of the
+dimensions below, which means it can be answered from a cube holding those sums per
+combination of dimension values. The cube size is bounded by the number of distinct
+dimension values instead of by the number of customers.
+"""
+import pandas as pd
+
+
+# the columns the dashboard filters or groups by. thedayunix is derived from theday, so it
+# does not add any cells to the cube
+DIMENSIONS = ['experimenttypename', 'experimentmodename', 'experimentmodeid', 'theday', 'thedayunix',
+              'isdesktop', 'culturekey', 'channel', 'segment']
+
+# the dimensions whose distinct values are offered in the dropdowns
+DROPDOWN_DIMENSIONS = ['experimenttypename', 'culturekey', 'channel', 'segment']
+
+# the metrics offered in the metric dropdown
+METRICS = ['trial', 'sco30m', 'completedcheckout30m', 'qp6h', 'paid', 'edit30m', 'w1return',
+           'lowqualret', 'medqualret', 'highqualret']
+
+
+def group_sum(df, by, metrics):
+    """
+    Sums the metrics of df per observed combination of the by columns, as a flat data frame.
+
+    Categorical columns are grouped by their integer codes, which is faster and sidesteps
+    pandas grouping by every unobserved combination of categories.
+    """
+    by = [by] if isinstance(by, basestring) else list(by)
+    categoricals = dict((c, df[c].cat.categories) for c in by if str(df[c].dtype) == 'category')
+    keys = [df[c].cat.codes.rename(c) if c in categoricals else df[c] for c in by]
+
+    result = df[metrics].groupby(keys, sort=False).sum().reset_index()
+
+    # pandas keeps or floats the small input int types, the sums need the full integer range
+    result[metrics] = result[metrics].astype('int64')
+
+    for column, categories in categoricals.items():
+        result[column] = pd.Categorical.from_codes(result[column], categories)
+
+    return result
+
+
+def build_cube(df, dimensions=DIMENSIONS, metrics=METRICS):
+    """
+    Sums the metrics of the data frame for every observed combination of the dimensions.
+
+    Args:
+        df: the dashboard data, one row per customer or per group of customers.
+        dimensions: the columns to keep as cube coordinates. Missing columns are ignored.
+        metrics: the columns to sum. Missing columns are ignored.
+
+    returns:
+        a data frame with one row per cube cell, the dimensions as columns and the metric sums.
+    """
+    dimensions = [d for d in dimensions if d in df.columns]
+    metrics = [m for m in metrics if m in df.columns]
+    return group_sum(df, dimensions, metrics)
+
+
+def sum_by(cube, by, metrics=None):
+    """
+    Sums a (possibly filtered) cube over every dimension not in by.
+
+    Args:
+        cube: a data frame as returned by build_cube, or a slice of it.
+        by: the dimension, or list of dimensions, to keep.
+        metrics: the metrics to return, all of them by default.
+
+    returns:
+        a data frame with one row per combination of the by values, sorted by them.
+    """
+    metrics = metrics or [m for m in METRICS if m in cube.columns]
+    by = [by] if isinstance(by, basestring) else list(by)
+    return group_sum(cube, by, metrics).sort_values(by).reset_index(drop=True)
+
+
+def build_dimension_index(df, dimensions=DROPDOWN_DIMENSIONS):
+    """ Returns a dictionary mapping each dimension column to a sorted list of its distinct values """
+    index = {}
+    for column in dimensions:
+        if column in df.columns:
+            values = df[column].cat.categories if str(df[column].dtype) == 'category' else df[column].unique()
+            index[column] = sorted(values)
+    return index
@@ -1,9 +1,23 @@
 import argparse
+import hashlib
+import sys
 import psycopg2
 import os
 import datetime
 import pandas as pd
 import yaml
+from pandas.api.types import union_categoricals
+from connection_pool import ConnectionPool
+from data_store import prepare_data
+from partitions import PartitionCache, contiguous_ranges, day_range
+from query_builder import build_grouped_query, PUSHDOWN_DIMENSIONS
+from cube import METRICS
+from stats import compare_experiments
+from report import experiment_report
+
+
+# a (name, date start, date end) range that matches no rows, its start is after its end
+NO_ROWS_RANGE = ('', '9999-12-31', '0000-01-01')
 
 
 class DataExtractor:
@@ -20,16 +34,55 @@ class DataExtractor:
         base_query: The path to the query that is later modified by this class. inserting
             the propoer where statements to filter for the proper experiments
 
+        partition_dir: Optional folder used to cache the extracted data by experiment and day.
+            If given, only the days that are not cached yet or that can still change are
+            extracted from the DB, see extract_incremental.
+
+        parallelism: How many queries run concurrently. If bigger than 1, the data is extracted
+            with one query per experiment (or per chunk_days days of an experiment) instead of
+            a single query, see extract_parallel.
+
+        chunk_days: Optional maximum number of days covered by each parallel query.
+
+        connection_pool: Optional ConnectionPool used by the parallel queries, which then run on
+            its threads and reuse its connections. By default a pool of parallelism connections
+            is created and closed for every extraction.
+
+        chunksize: Optional number of rows to read at a time. If given, query results are read
+            in chunks through a server side cursor and typed as they arrive, see iter_query.
+
+        pushdown: Whether to aggregate in the DB. If set, every query sums the metrics per
+            combination of the dashboard dimensions with a parameterized GROUP BY, so only
+            the aggregates cross the network, see query_builder.build_grouped_query.
+
+        extract: Whether to extract the data right away. Set it to False to stream the data
+            with iter_chunks or stream_csv instead of holding all of it in memory.
+
     """
 
     def __init__(self,
                  experiment_params = None,
-                 base_query = 'sql/base_sql_grouped.sql'):
+                 base_query = 'sql/base_sql_grouped.sql',
+                 partition_dir = None,
+                 parallelism = 1,
+                 chunk_days = None,
+                 connection_pool = None,
+                 chunksize = None,
+                 pushdown = False,
+                 extract = True):
         self.experiment_params = experiment_params
         self.base_query = open(base_query).read()
+        self.partition_dir = partition_dir
+        self.parallelism = parallelism
+        self.chunk_days = chunk_days
+        self.connection_pool = connection_pool
+        self.chunksize = chunksize
+        self.pushdown = pushdown
         self.yesterday_date = self.get_yesterday()
         self.query = self.mount_query()
-        self.data = self.extract_data()
+        self.data = None
+        if extract:
+            self.data = self.extract_incremental() if partition_dir else self.extract_data()
 
 
 
@@ -41,32 +94,32 @@ class DataExtractor:
 
     def connect(self):
         """ Returns a connection to the database """
-        conn_str = "dbname={} user={} host={} port={} password={}".format(
-            os.environ['PGDATABASE'],
-            os.environ['PGUSER'],
-            os.environ['PGHOST'],
-            os.environ['PGPORT'],
-            os.environ['RSPASSWORD'])
-        try:
-            conn = psycopg2.connect(conn_str)
-            # the command below will force the connection not to use cashing
-            conn.set_session(readonly=True, autocommit = True)
-        except Exception as e:
-            print "Could not establish a connection with Redshit because of the following exception"
-            print e
-        return conn
+        return connect()
 
-    def mount_query(self):
-        """ Creates the text SQL query based on the experiment parameters """
-
-        where_statements = []
+    def experiment_ranges(self):
+        """ Returns a (name, date start, date end) tuple for every experiment in the parameters """
+        ranges = []
         for key, value in self.experiment_params.iteritems():
             # get params from yaml 
             exp_name = key
             date_start = value['dates'][0] if value['dates'][0] else self.yesterday_date
             date_end = value['dates'][1] if value['dates'][1] else self.yesterday_date
+            ranges.append((exp_name, date_start, date_end))
+        return ranges
+
+    def mount_query(self, date_ranges = None):
+        """
+        Creates the text SQL query based on the experiment parameters
 
+        Args:
+            date_ranges: optional list of (name, date start, date end) tuples to extract, instead
+                of the full date range of every experiment in the parameters
+        """
+        if date_ranges is None:
+            date_ranges = self.experiment_ranges()
 
+        where_statements = []
+        for exp_name, date_start, date_end in date_ranges:
             where_statements.append("(theday >= '{}' and theday <= '{}' "\
             "and experimenttypename = '{}')".format(date_start,
                                                           date_end,
@@ -75,23 +128,231 @@ class DataExtractor:
         where = " or \n".join(where_statements)
 
         #return '{} where {}'.format(self.base_query, where)
-	return self.base_query.format(where)
+        return self.base_query.format(where)
 
 
-    def extract_data(self):
-        """ Uses the created query to extract the data """
+    def extract_data(self, date_ranges = None):
+        """
+        Uses the created query to extract the data
 
+        Args:
+            date_ranges: the (name, date start, date end) tuples the query was mounted for, by
+                default every experiment in the parameters.
+        """
+        date_ranges = date_ranges or self.experiment_ranges()
+        if self.parallelism > 1:
+            return self.extract_parallel(date_ranges)
 
         conn = self.connect()
-        data = pd.read_sql_query(self.query, conn)
-	conn.close()
+        data = self.query_ranges(date_ranges, conn)
+        conn.close()
+
+        return data
 
+    def query_ranges(self, date_ranges, conn):
+        """ Extracts the (name, date start, date end) ranges on conn, aggregated by the DB in pushdown mode """
+        if self.pushdown:
+            query, params = build_grouped_query(self.base_query, date_ranges, paramstyle = paramstyle(conn))
+            return pd.read_sql_query(query, conn, params = params)
+        return self.read_query(self.mount_query(date_ranges), conn)
+
+    def aggregate(self, filters = None, group_by = PUSHDOWN_DIMENSIONS, metrics = METRICS, date_ranges = None):
+        """
+        Answers an ad-hoc question in the DB, returning the metric sums per group by values.
+
+        Args:
+            filters: a dictionary mapping dimension columns to a value or to a list of values.
+            group_by: the dimension columns to group by.
+            metrics: the metric columns to sum.
+            date_ranges: the (name, date start, date end) tuples to include, by default every
+                experiment in the parameters.
+        """
+        conn = self.connect()
+        query, params = build_grouped_query(self.base_query, date_ranges or self.experiment_ranges(),
+                                            filters, group_by, metrics, paramstyle(conn))
+        data = pd.read_sql_query(query, conn, params = params)
+        conn.close()
         return data
 
+    def iter_query(self, query, conn, chunksize):
+        """
+        Runs a query and yields its result as typed data frames of at most chunksize rows.
+
+        On psycopg2 connections the rows are fetched through a named (server side) cursor, so
+        neither the client nor the driver ever hold more than one chunk of rows. Named cursors
+        only live inside a transaction block, and Redshift has no WITH HOLD cursors, so the
+        query runs in a transaction of its own with autocommit turned off, and autocommit is
+        restored once the cursor is closed. Redshift still materializes the whole result on
+        its leader node, the chunks only bound the memory of this process. Every chunk is
+        typed right away: text dimensions become categoricals and the 0/1 metrics int8. Only
+        an empty result yields an empty frame, so it still carries the columns.
+        """
+        transaction = is_postgres(conn)
+        if transaction:
+            autocommit = conn.autocommit
+            conn.autocommit = False
+            cursor = conn.cursor(name = 'experiments_stream')
+            cursor.itersize = chunksize
+        else:
+            cursor = conn.cursor()
+
+        # a failing query still closes the cursor, which for a named cursor lives on the server,
+        # and ends its transaction. The transaction only reads, so it is always rolled back
+        try:
+            cursor.execute(query)
+            empty = True
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                if not rows:
+                    break
+                # named cursors only know their columns after the first fetch
+                columns = [column[0] for column in cursor.description]
+                yield prepare_data(pd.DataFrame.from_records(rows, columns = columns))
+                empty = False
+            if empty:
+                columns = [column[0] for column in cursor.description]
+                yield prepare_data(pd.DataFrame.from_records([], columns = columns))
+        finally:
+            try:
+                cursor.close()
+            finally:
+                if transaction:
+                    conn.rollback()
+                    conn.autocommit = autocommit
+
+    def read_query(self, query, conn):
+        """ Runs a query and returns its result as a data frame, read in typed chunks if chunksize is set """
+        if not self.chunksize:
+            return pd.read_sql_query(query, conn)
+        return concat_chunks(list(self.iter_query(query, conn, self.chunksize)))
+
+    def iter_chunks(self, chunksize = 50000):
+        """ Runs the query and yields its result as typed data frames, see iter_query """
+        conn = self.connect()
+        try:
+            for chunk in self.iter_query(self.query, conn, chunksize):
+                yield chunk
+        finally:
+            conn.close()
+
+    def split_ranges(self, date_ranges):
+        """ Splits (name, date start, date end) tuples into chunks of at most chunk_days days """
+        if not self.chunk_days:
+            return list(date_ranges)
+
+        chunks = []
+        for exp_name, date_start, date_end in date_ranges:
+            days = day_range(date_start, date_end)
+            for i in range(0, len(days), self.chunk_days):
+                chunk = days[i:i + self.chunk_days]
+                chunks.append((exp_name, chunk[0], chunk[-1]))
+        return chunks
+
+    def extract_parallel(self, date_ranges):
+        """
+        Extracts the data with one query per experiment, or per chunk of days of an experiment,
+        running up to parallelism queries at the same time on a bounded connection pool.
+
+        The results are merged into one frame with the same columns as a single query returns,
+        so the wall clock time is roughly the one of the slowest query instead of their sum.
+        """
+        pool = self.connection_pool or ConnectionPool(self.connect, self.parallelism)
+        try:
+            frames = pool.map(lambda conn, date_range: self.query_ranges([date_range], conn),
+                              self.split_ranges(date_ranges))
+        finally:
+            if pool is not self.connection_pool:
+                pool.close()
+
+        # ranges without rows come back untyped, and would turn every column into objects
+        frames = non_empty(frames)
+        return concat_chunks(frames) if self.chunksize else pd.concat(frames, ignore_index = True)
+
+    def extract_incremental(self):
+        """
+        Extracts the data through the partition cache.
+
+        Only the days that are missing from the cache or are not final yet are queried, and
+        they are stored as one partition per experiment and day. Days before yesterday are
+        final, yesterday and today are extracted again on every call since their data can
+        still change. The full data is then assembled from the partitions.
+        """
+        cache = PartitionCache(self.partition_dir, self.query_hash())
+        today = datetime.date.today()
+        last_final_day = (today - datetime.timedelta(2)).strftime('%Y-%m-%d')
+
+        # there is no data for days that did not happen yet
+        experiment_days = {}
+        for exp_name, date_start, date_end in self.experiment_ranges():
+            date_end = min(date_end, today.strftime('%Y-%m-%d'))
+            experiment_days[exp_name] = day_range(date_start, date_end) if date_start <= date_end else []
+
+        date_ranges = []
+        for exp_name, days in experiment_days.iteritems():
+            missing_days = [day for day in days if not cache.is_final(exp_name, day)]
+            date_ranges.extend((exp_name, start, end) for start, end in contiguous_ranges(missing_days))
+
+        if date_ranges:
+            self.query = self.mount_query(date_ranges)
+            data = self.extract_data(date_ranges)
+            days = pd.to_datetime(data['theday']).dt.strftime('%Y-%m-%d')
+            partitions = dict(iter(data.groupby([data['experimenttypename'], days])))
+
+            # days without any rows are stored as empty partitions so they are not queried again
+            for exp_name, date_start, date_end in date_ranges:
+                for day in day_range(date_start, date_end):
+                    rows = partitions.get((exp_name, day), data.iloc[:0])
+                    cache.write(exp_name, day, rows, final = day <= last_final_day)
+            cache.write_manifest()
+
+        frames = [frame for exp_name, days in experiment_days.iteritems() for frame in cache.read(exp_name, days)]
+        return pd.concat(non_empty(frames), ignore_index = True) if frames else self.empty_data()
+
+    def query_hash(self):
+        """ Returns a hash of the query the data is extracted with, its SQL shape in pushdown mode, identifying its partitions """
+        if self.pushdown:
+            # the date ranges are bound parameters, so any range gives the same SQL text
+            query = build_grouped_query(self.base_query, [NO_ROWS_RANGE])[0]
+        else:
+            query = self.base_query
+        return hashlib.md5('pushdown={}\n{}'.format(self.pushdown, query)).hexdigest()
+
+    def empty_data(self):
+        """ Returns a frame without rows, with the columns and types of the query result """
+        conn = self.connect()
+        try:
+            return prepare_data(self.query_ranges([NO_ROWS_RANGE], conn))
+        finally:
+            conn.close()
+
     def output_csv(self, path):
         """ Outputs the data to a csv file """
         self.data.to_csv(path)
 
+    def output_parquet(self, path):
+        """ Outputs the data to a parquet file, requires pyarrow """
+        self.data.to_parquet(path, engine = 'pyarrow')
+
+    def output_json(self, path):
+        """ Outputs the data to a json file, as a list of records """
+        self.data.to_json(path, orient = 'records', date_format = 'iso')
+
+    def output_feather(self, path):
+        """ Outputs the data to a feather file, keeping categorical columns, requires pyarrow """
+        # pandas' to_feather needs the separate feather-format package, pyarrow alone is enough here
+        import pyarrow.feather
+        pyarrow.feather.write_feather(self.data.reset_index(drop = True), path)
+
+    def stream_csv(self, path = None, chunksize = 50000):
+        """ Streams the query result to a csv file, or to stdout if no path is given, one chunk at a time """
+        out = open(path, 'w') if path else sys.stdout
+        try:
+            for i, chunk in enumerate(self.iter_chunks(chunksize)):
+                chunk.to_csv(out, header = i == 0, index = False)
+        finally:
+            if path:
+                out.close()
+
     def output_stdout(self):
         """ Outputs the data to stdout """
         print self.data.to_string()
@@ -101,12 +362,81 @@ class DataExtractor:
         return self.data
 
 
+def connect():
+    """ Returns a connection to Redshift, configured by the PG* and RSPASSWORD environment variables """
+    conn_str = "dbname={} user={} host={} port={} password={}".format(
+        os.environ['PGDATABASE'],
+        os.environ['PGUSER'],
+        os.environ['PGHOST'],
+        os.environ['PGPORT'],
+        os.environ['RSPASSWORD'])
+    try:
+        conn = psycopg2.connect(conn_str)
+        # the command below will force the connection not to use cashing
+        conn.set_session(readonly=True, autocommit = True)
+    except Exception as e:
+        print "Could not establish a connection with Redshit because of the following exception"
+        print e
+    return conn
+
+
+def is_postgres(conn):
+    """ Whether conn is a psycopg2 connection, to Redshift or PostgreSQL """
+    return isinstance(conn, psycopg2.extensions.connection)
+
+
+def paramstyle(conn):
+    """ Returns the parameter style of the connection, pyformat for psycopg2 and named for anything else (sqlite3) """
+    return 'pyformat' if is_postgres(conn) else 'named'
+
+
+def non_empty(frames):
+    """ Returns the frames that have rows, or only the first frame if none of them has any """
+    return [frame for frame in frames if len(frame)] or frames[:1]
+
+
+def concat_chunks(chunks):
+    """ Concatenates typed data frames with the same columns, keeping categorical columns categorical """
+    # frames without rows have no categories to union and would turn other columns into objects
+    chunks = non_empty(chunks)
+    columns = chunks[0].columns
+    categoricals = [column for column in columns if str(chunks[0][column].dtype) == 'category']
+    data = pd.concat([chunk.drop(categoricals, axis = 1) for chunk in chunks], ignore_index = True)
+    for column in categoricals:
+        data[column] = union_categoricals([chunk[column] for chunk in chunks])
+    return data[columns]
+
+
 def main(**kwargs):
 
     base_query = kwargs['base_query']
     exp_config = yaml.load(open(kwargs['config'], 'r'))
-    data_extractor = DataExtractor(exp_config, base_query)
-    if kwargs['output_path']:
+
+    # streaming never holds the full result, so it skips the regular extraction
+    if kwargs['stream']:
+        data_extractor = DataExtractor(exp_config, base_query, extract = False)
+        data_extractor.stream_csv(kwargs['output_path'], kwargs['chunksize'] or 50000)
+        return
+
+    data_extractor = DataExtractor(exp_config, base_query, kwargs['partition_dir'],
+                                   parallelism = kwargs['parallelism'],
+                                   chunk_days = kwargs['chunk_days'],
+                                   chunksize = kwargs['chunksize'],
+                                   pushdown = kwargs['pushdown'])
+    # the comparison of every arm to the control arm is written instead of the data itself
+    if kwargs['stats']:
+        data_extractor.data = compare_experiments(data_extractor.get_data(), confidence = kwargs['confidence'])
+    # or the per day and total ratios and bounds the dashboard shows, for every experiment, arm and metric
+    elif kwargs['report']:
+        data_extractor.data = experiment_report(data_extractor.get_data(), confidence = kwargs['confidence'],
+                                                resamples = kwargs['resamples'], processes = kwargs['processes'])
+    if kwargs['output_path'] and kwargs['output_format'] == 'parquet':
+        data_extractor.output_parquet(kwargs['output_path'])
+    elif kwargs['output_path'] and kwargs['output_format'] == 'feather':
+        data_extractor.output_feather(kwargs['output_path'])
+    elif kwargs['output_path'] and kwargs['output_format'] == 'json':
+        data_extractor.output_json(kwargs['output_path'])
+    elif kwargs['output_path']:
         data_extractor.output_csv(kwargs['output_path'])
     else:
         data_extractor.output_stdout()
@@ -122,5 +452,29 @@ if __name__ == "__main__":
                         help = 'sql file with the base query string')
     parser.add_argument('-o', '--output_path',
                         help = 'if the output is to be saved in a csv, specify the path here')
+    parser.add_argument('-f', '--output_format', choices = ['csv', 'parquet', 'feather', 'json'], default = 'csv',
+                        help = 'file format of the output path, parquet and feather require pyarrow')
+    parser.add_argument('-p', '--partition_dir',
+                        help = 'folder where extracted days are cached, so that only new days are queried')
+    parser.add_argument('-j', '--parallelism', type = int, default = 1,
+                        help = 'how many queries to run concurrently, one per experiment or chunk of days')
+    parser.add_argument('--chunk_days', type = int,
+                        help = 'maximum number of days covered by each concurrent query')
+    parser.add_argument('--chunksize', type = int,
+                        help = 'read query results this many rows at a time through a server side cursor')
+    parser.add_argument('--pushdown', action = 'store_true',
+                        help = 'sum the metrics per dashboard dimensions in the DB instead of extracting every row')
+    parser.add_argument('-s', '--stream', action = 'store_true',
+                        help = 'stream the rows to the csv or stdout in chunks instead of loading them all first')
+    parser.add_argument('--stats', action = 'store_true',
+                        help = 'output the lift, confidence interval and p-value of every arm and metric against the control arm instead of the data')
+    parser.add_argument('--confidence', type = float, default = 0.95,
+                        help = 'coverage of the confidence intervals output with --stats or --report')
+    parser.add_argument('--report', action = 'store_true',
+                        help = 'output the per day and total ratios and bounds of every experiment, arm and metric, as the dashboard shows them, instead of the data')
+    parser.add_argument('--resamples', type = int, default = 2000,
+                        help = 'bootstrap resamples of the days behind the total bounds of --report, 0 uses the normal approximation')
+    parser.add_argument('--processes', type = int, default = 1,
+                        help = 'how many experiments --report computes at the same time')
 
     main(**vars(parser.parse_args()))
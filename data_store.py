@@ -0,0 +1,213 @@
+import hashlib
+import json
+import threading
+import time
+
+import pandas as pd
+
+from cube import METRICS
+
+
+# columns with few distinct values, stored as pandas categoricals to save memory
+# and to make comparisons and isin lookups cheap
+CATEGORICAL_COLUMNS = ['experimenttypename', 'experimentmodename', 'culturekey', 'channel', 'segment']
+
+# integer columns, which come back as objects from results without rows
+NUMERIC_COLUMNS = METRICS + ['experimentmodeid', 'isdesktop']
+
+
+def config_hash(exp_params):
+    """ Returns a short, stable hash of the experiment configuration """
+    return hashlib.md5(json.dumps(exp_params, sort_keys=True, default=str)).hexdigest()[:12]
+
+
+def prepare_data(df):
+    """
+    Casts the raw dashboard data to compact types.
+
+    Text dimensions become categoricals and integer columns are downcast to the smallest
+    integer type that holds them (the 0/1 metrics end up as int8). Metric and flag columns
+    that came as objects are made numeric first.
+    """
+    df = df.copy()
+    for column in CATEGORICAL_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+
+    for column in NUMERIC_COLUMNS:
+        if column in df.columns and df[column].dtype == object:
+            df[column] = pd.to_numeric(df[column])
+
+    for column in df.select_dtypes(include=['integer']).columns:
+        df[column] = pd.to_numeric(df[column], downcast='integer')
+
+    return df
+
+
+class DataSnapshot:
+    """
+    One loaded version of the dashboard data together with everything derived from it.
+
+    Args:
+        data: the typed data frame.
+        config_hash: the hash of the experiment configuration the data was loaded for.
+        loaded_at: unix time of when the data was loaded.
+        derived: a dictionary of structures built from data, such as aggregates.
+    """
+
+    def __init__(self, data, config_hash, loaded_at, derived):
+        self.data = data
+        self.config_hash = config_hash
+        self.loaded_at = loaded_at
+        self.derived = derived
+
+    @property
+    def version(self):
+        """ A string identifying this version of the data """
+        return "{}-{}".format(self.config_hash, int(self.loaded_at * 1000))
+
+
+class DataStore:
+    """
+    Process-resident store for the dashboard data frame.
+
+    The frame is parsed and typed once and then handed to every callback as is, so callers
+    must treat it as read only. Each stored frame is versioned by the hash of the experiment
+    configuration it was loaded for and by its load time, and it is reloaded when the
+    configuration changes or when it gets older than max_age seconds.
+
+    Refreshes are single flight: at most one runs per process, and with a refresh_lock at
+    most one runs per node, while the others wait for its result instead of loading the data
+    again. When the stored frame is merely expired, it keeps being served while the refresh
+    runs in a background thread (stale while revalidate). New snapshots are swapped in with a
+    single assignment once their derived structures are built, so readers see either the old
+    or the new version, never a mix.
+
+    Args:
+        max_age: how many seconds a loaded frame is served before it is reloaded.
+        builders: a list of (name, function) pairs. Each function takes the typed data frame and
+            the dictionary of the structures built by the builders before it, and returns a
+            structure derived from them. They run in order once per loaded frame, and their
+            results are available in the derived dictionary of the snapshot.
+        snapshots: an optional snapshot.SnapshotStore. Every loaded frame is written to it, and
+            a process with an empty or stale store reads it from there, as long as it is fresh,
+            before falling back to the loader.
+        refresh_lock: an optional file_lock.FileLock shared by every worker of the node. It is
+            held while refreshing, and should be used together with snapshots, since that is
+            how the waiting workers get the result.
+    """
+
+    def __init__(self, max_age, builders=None, snapshots=None, refresh_lock=None):
+        self.max_age = max_age
+        self.builders = builders or []
+        self.snapshots = snapshots
+        self.refresh_lock = refresh_lock
+        self.snapshot = None
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        """ A string identifying the currently stored data, or None if nothing is stored """
+        return self.snapshot.version if self.snapshot else None
+
+    def is_fresh(self, exp_params, newer_than=None):
+        """ Whether the stored frame was loaded for exp_params, has not expired and was loaded after newer_than """
+        snapshot = self.snapshot
+        return snapshot is not None and \
+            snapshot.config_hash == config_hash(exp_params) and \
+            time.time() - snapshot.loaded_at < self.max_age and \
+            snapshot.loaded_at >= (newer_than or 0)
+
+    def get_snapshot(self, exp_params, loader):
+        """
+        Returns the stored snapshot for the given experiment configuration.
+
+        Args:
+            exp_params: the experiment configuration the data should correspond to.
+            loader: a function without arguments returning the raw data frame. It is only
+                called when neither the stored frame nor the on-disk snapshot is fresh.
+        """
+        if self.is_fresh(exp_params):
+            return self.snapshot
+
+        # expired data of the same configuration is still served while it gets refreshed
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.config_hash == config_hash(exp_params):
+            self.refresh_in_background(exp_params, loader)
+            return snapshot
+
+        self.refresh(exp_params, loader)
+        return self.snapshot
+
+    def refresh(self, exp_params, loader, blocking=True, newer_than=None):
+        """
+        Makes sure the stored frame is fresh for the given experiment configuration.
+
+        If another thread or worker is refreshing, this waits for it and picks up its result,
+        or, if blocking is False, returns False right away. Data loaded before the unix time
+        newer_than is not considered fresh, which forces a reload on schedule.
+        """
+        if not self._lock.acquire(blocking):
+            return False
+        try:
+            # another thread may have loaded the data while we waited for the lock
+            if self.is_fresh(exp_params, newer_than):
+                return True
+            if self.refresh_lock is not None:
+                self.refresh_lock.acquire()
+            try:
+                # or another worker, in which case its snapshot is on disk
+                if not self.load_snapshot(exp_params, newer_than):
+                    self.set(loader(), exp_params)
+            finally:
+                if self.refresh_lock is not None:
+                    self.refresh_lock.release()
+            return True
+        finally:
+            self._lock.release()
+
+    def refresh_in_background(self, exp_params, loader):
+        """ Starts a refresh in a background thread, unless this process is already refreshing """
+        if self._lock.locked():
+            return
+
+        def run():
+            try:
+                self.refresh(exp_params, loader, blocking=False)
+            except Exception as e:
+                print "refreshing the data failed, serving the previous data: {}".format(e)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def load_snapshot(self, exp_params, newer_than=None):
+        """ Loads the on-disk snapshot if it is fresh for exp_params, returning whether it did, see is_fresh """
+        if self.snapshots is None:
+            return False
+
+        metadata = self.snapshots.metadata()
+        if not metadata or metadata['config_hash'] != config_hash(exp_params) or \
+                time.time() - metadata['loaded_at'] >= self.max_age or \
+                metadata['loaded_at'] < (newer_than or 0):
+            return False
+
+        data, metadata = self.snapshots.read()
+        self.store(data, metadata['config_hash'], metadata['loaded_at'])
+        return True
+
+    def set(self, df, exp_params):
+        """ Types and stores a new frame for the given experiment configuration """
+        data = prepare_data(df)
+        loaded_at = time.time()
+        if self.snapshots is not None:
+            self.snapshots.write(data, config_hash=config_hash(exp_params), loaded_at=loaded_at)
+        return self.store(data, config_hash(exp_params), loaded_at)
+
+    def store(self, data, config_hash, loaded_at):
+        """ Builds the derived structures of an already typed frame and makes it the current snapshot """
+        derived = {}
+        for name, build in self.builders:
+            derived[name] = build(data, derived)
+        self.snapshot = DataSnapshot(data, config_hash, loaded_at, derived)
+        return self.snapshot
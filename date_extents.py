@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+
+
+DAY_SECONDS = 86400
+
+
+def get_marks(data, n):
+    '''
+    Get the marks for the dash graph based on the data series and how many intervals should be displayed
+
+    Args:
+        data: a pandas series (or array) of dates as ints in the unix format.
+        n: how many intervals should be in the marks
+
+    Examples:
+        if the data ranges from 2018-02-01 to 2018-02-21 and n = 4
+        then the output will be:
+            {unixdate: 2018-02-01, unixdate: 2018-02-07, unixdate: 2018-02-14, unixdate: 2018-02-21}
+
+    returns:
+        a dictonary mapping a unix value to a string representing a date in the format YYYY-mm-dd
+    '''
+    # every day from min to max, as unix times at midnight UTC like thedayunix
+    first = int(np.min(data)) // DAY_SECONDS * DAY_SECONDS
+    days = np.arange(first, int(np.max(data)) + 1, DAY_SECONDS)
+    index = np.arange(len(days))
+
+    # include the first and last dates, and then either all of them or evenly spaced ones
+    keep = (index == 0) | (index == len(days) - 1)
+    if n > len(days) - 2:
+        keep[:] = True
+    else:
+        keep |= index % (len(days) // n) == 0
+
+    labels = pd.to_datetime(days[keep], unit = 's').strftime('%Y-%m-%d')
+    return dict(zip(days[keep].tolist(), labels))
+
+
+def build_date_extents(df, n = 10):
+    '''
+    Returns the date slider state of every experiment in df.
+
+    Args:
+        df: the data or the cube, with the experimenttypename and thedayunix columns.
+        n: how many intervals the marks should have, see get_marks.
+
+    returns:
+        a dictionary mapping every experiment to a dictionary with the min, max, marks and
+        value of its date slider.
+    '''
+    extents = df['thedayunix'].groupby(df['experimenttypename'].astype(str)).agg(['min', 'max'])
+    states = {}
+    for experiment, extent in extents.iterrows():
+        day_min, day_max = int(extent['min']), int(extent['max'])
+        states[experiment] = {'min': day_min, 'max': day_max, 'value': [day_min, day_max],
+                              'marks': get_marks([day_min, day_max], n)}
+    return states
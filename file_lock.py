@@ -0,0 +1,45 @@
+import errno
+import fcntl
+
+
+class FileLock:
+    """
+    An exclusive lock shared by every process on a node, backed by flock on a file.
+
+    The lock is released by the OS if its holder dies, so a crashed worker never leaves it
+    taken. An instance holds at most one lock at a time, so threads sharing an instance
+    must serialize their use of it.
+
+    Args:
+        path: the file to lock. It is created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self, blocking = True):
+        """ Takes the lock, waiting for it if blocking, and returns whether it was taken """
+        lock_file = open(self.path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            lock_file.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        self._file = lock_file
+        return True
+
+    def release(self):
+        """ Releases the lock """
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
@@ -0,0 +1,96 @@
+import numpy as np
+
+
+# the multi value filters of the dashboard, each with a row bitmap per distinct value
+BITMAP_COLUMNS = ['isdesktop', 'culturekey', 'channel', 'segment']
+
+
+class FilterIndex:
+    """
+    Index resolving the dashboard filters to a row selection in one pass.
+
+    The rows are sorted by experiment and day, so an experiment is a contiguous range of rows
+    and a date range within it is found by binary search. Every other filter column has a
+    boolean row bitmap per distinct value. A filter combination is answered by slicing the
+    bitmaps to the rows of the experiment and dates, OR-ing the bitmaps of the selected values
+    of each column and AND-ing the columns, followed by a single gather of the matching rows.
+    The work therefore scales with the rows of the selected experiment and dates, and no
+    intermediate frames are created.
+
+    Args:
+        df: the frame to index, usually the cube of cube.build_cube. It needs the
+            experimenttypename and thedayunix columns.
+        bitmap_columns: the columns to build bitmaps for. Missing columns are ignored.
+    """
+
+    def __init__(self, df, bitmap_columns = BITMAP_COLUMNS):
+        experiments = df['experimenttypename'].astype('category')
+        order = np.lexsort((df['thedayunix'].values, experiments.cat.codes.values))
+        self.data = df.take(order).reset_index(drop = True)
+        self.days = self.data['thedayunix'].values
+
+        # the rows of every experiment are contiguous after sorting
+        codes = experiments.cat.codes.values[order]
+        bounds = np.searchsorted(codes, np.arange(len(experiments.cat.categories) + 1))
+        self.experiment_rows = dict((experiment, (bounds[i], bounds[i + 1]))
+                                    for i, experiment in enumerate(experiments.cat.categories))
+
+        self.bitmaps = {}
+        for column in bitmap_columns:
+            if column not in self.data.columns:
+                continue
+            values = self.data[column].astype('category')
+            value_codes = values.cat.codes.values
+            self.bitmaps[column] = dict((value, value_codes == i) for i, value in enumerate(values.cat.categories))
+
+    def __len__(self):
+        return len(self.data)
+
+    def rows(self, date_range, experiment):
+        """ Returns the (start, end) row range of an experiment, narrowed to a date range if the experiment is given """
+        if experiment is None:
+            return 0, len(self.data)
+        start, end = self.experiment_rows.get(experiment, (0, 0))
+        days = self.days[start:end]
+        return (start + np.searchsorted(days, date_range[0], side = 'left'),
+                start + np.searchsorted(days, date_range[1], side = 'right'))
+
+    def positions(self, date_range, isdesktop, experiment, language, channels, segments):
+        """ Returns the positions of the rows matching the filters, see select """
+        start, end = self.rows(date_range, experiment)
+
+        mask = None
+        if experiment is None:
+            # without an experiment the days are not sorted, so they are filtered like the rest
+            mask = (self.days >= date_range[0]) & (self.days <= date_range[1])
+
+        selections = [('isdesktop', [isdesktop] if isdesktop is not None else None),
+                      ('culturekey', language),
+                      ('channel', channels),
+                      ('segment', segments)]
+        for column, values in selections:
+            if not values or column not in self.bitmaps:
+                continue
+            column_mask = np.zeros(end - start, dtype = bool)
+            for value in values:
+                if value in self.bitmaps[column]:
+                    column_mask |= self.bitmaps[column][value][start:end]
+            mask = column_mask if mask is None else mask & column_mask
+
+        if mask is None:
+            return np.arange(start, end)
+        return start + np.flatnonzero(mask)
+
+    def select(self, date_range, isdesktop, experiment, language, channels, segments):
+        """
+        Returns the rows matching the dashboard filters.
+
+        Args:
+            date_range: a [start, end] list of unix times, both inclusive.
+            isdesktop: the device (1 or 0), or None for every device.
+            experiment: the experiment name, or None for every experiment.
+            language: the culture keys to keep, or None/empty for all of them.
+            channels: the channels to keep, or None/empty for all of them.
+            segments: the segments to keep, or None/empty for all of them.
+        """
+        return self.data.take(self.positions(date_range, isdesktop, experiment, language, channels, segments))
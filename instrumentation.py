@@ -0,0 +1,247 @@
+"""
+Latency histograms, counters and gauges for the dashboard, in the Prometheus text format.
+
+Stages of the hot paths are timed with the timer context manager or the timed decorator, and
+end up in the experiments_stage_seconds histogram labeled by stage. Inside a Flask request the
+stage timings are also collected per request, so a request can be logged with its trace ID
+and the time it spent in every stage, see instrument_server.
+
+The metrics live in the memory of each process and nothing aggregates them across processes.
+Under gunicorn a scrape of the metrics route reaches whichever worker accepts it and returns the
+metrics of that worker only, labeled with its pid in the worker label. Every worker is seen only
+over many scrapes, and the counts of a worker are lost when it restarts, so the metrics describe
+a sample of the traffic rather than all of it. A single worker, or a server per worker scraped
+on its own port, gives complete counts.
+"""
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import flask
+
+
+# latency buckets in seconds, from a dictionary lookup to a full load from the db
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# payload buckets in bytes
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+def format_labels(labels):
+    """ Returns the Prometheus text of a dictionary of labels, with the worker label added """
+    labels = OrderedDict(sorted(labels.items()) + [('worker', str(os.getpid()))])
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels.items()) + '}'
+
+
+def format_value(value):
+    """ Returns the Prometheus text of a sample value """
+    return '+Inf' if value == float('inf') else repr(float(value))
+
+
+class Counter:
+    """
+    A monotonic counter per combination of label values.
+
+    Args:
+        name: the metric name.
+        help: the description of the metric.
+    """
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount = 1, **labels):
+        """ Adds amount to the counter of the labels """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        """ Returns the lines of the metric in the Prometheus text format """
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            for key, value in sorted(self.values.items()):
+                lines.append('{}{} {}'.format(self.name, format_labels(dict(key)), format_value(value)))
+        return lines
+
+
+class Histogram:
+    """
+    Cumulative bucket counts, sum and count of observations per combination of label values.
+
+    Args:
+        name: the metric name.
+        help: the description of the metric.
+        buckets: the increasing upper bounds of the buckets, +Inf is added.
+    """
+
+    def __init__(self, name, help, buckets = SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """ Records an observation for the labels """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def render(self):
+        """ Returns the lines of the metric in the Prometheus text format """
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                labels = dict(key)
+                for bound, count in zip(self.buckets, counts):
+                    bucket_labels = dict(labels, le = format_value(bound) if bound == float('inf') else repr(bound))
+                    lines.append('{}_bucket{} {}'.format(self.name, format_labels(bucket_labels), count))
+                lines.append('{}_sum{} {}'.format(self.name, format_labels(labels), format_value(total)))
+                lines.append('{}_count{} {}'.format(self.name, format_labels(labels), counts[-1]))
+        return lines
+
+
+class Registry:
+    """
+    The metrics of a process, plus gauges read from callbacks when rendering.
+
+    Gauges are registered as functions without arguments returning a list of (labels, value)
+    pairs, so values that other objects already keep, such as cache sizes, are not copied.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.gauges = []
+
+    def counter(self, name, help):
+        """ Returns a new Counter registered under name """
+        metric = Counter(name, help)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, buckets = SECONDS_BUCKETS):
+        """ Returns a new Histogram registered under name """
+        metric = Histogram(name, help, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help, collect):
+        """ Registers a gauge whose samples come from collect() """
+        self.gauges.append((name, help, collect))
+
+    def render(self):
+        """ Returns every metric in the Prometheus text format """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for name, help, collect in self.gauges:
+            lines.extend(['# HELP {} {}'.format(name, help), '# TYPE {} gauge'.format(name)])
+            for labels, value in collect():
+                lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+# the registry of this process and the metrics every module shares
+registry = Registry()
+stage_seconds = registry.histogram('experiments_stage_seconds', 'Seconds spent in each stage of the dashboard hot paths')
+request_seconds = registry.histogram('experiments_request_seconds', 'Seconds spent serving each request, by route and output')
+response_bytes = registry.histogram('experiments_response_bytes', 'Size of the responses, by route and output', BYTES_BUCKETS)
+cache_requests = registry.counter('experiments_cache_requests_total', 'Cache lookups, by cache and result (hit or miss)')
+
+
+class timer:
+    """
+    Context manager timing a stage into the stage histogram, and into the current request if any.
+
+    Args:
+        stage: the name of the stage, such as filter or figure.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.time() - self.start
+        stage_seconds.observe(self.seconds, stage = self.stage)
+        if flask.has_request_context() and hasattr(flask.g, 'stages'):
+            flask.g.stages[self.stage] = flask.g.stages.get(self.stage, 0) + self.seconds
+
+
+def timed(stage):
+    """ Decorator timing every call of a function as the given stage, see timer """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def cache_lookup(cache, hit):
+    """ Counts a hit or a miss of the named cache """
+    cache_requests.inc(cache = cache, result = 'hit' if hit else 'miss')
+
+
+def request_output():
+    """ Returns the component property a dash update request is for, or an empty string """
+    body = flask.request.get_json(silent = True) or {}
+    output = body.get('output') or {}
+    return '{}.{}'.format(output.get('id'), output.get('property')) if output.get('id') else ''
+
+
+def instrument_server(server, path = '/metrics', trace = False, trace_header = 'X-Trace-Id'):
+    """
+    Times the requests of a Flask server and exposes the registry on a route.
+
+    Args:
+        server: the Flask server, app.server for a dash app.
+        path: the route serving the metrics in the Prometheus text format.
+        trace: whether to log a line per request, as JSON with its trace ID, duration,
+            response size and the seconds spent in every stage.
+        trace_header: the request header holding a trace ID set upstream. Requests without it
+            get a new one. It is returned in the same response header.
+    """
+    @server.before_request
+    def start_request():
+        flask.g.request_start = time.time()
+        flask.g.stages = {}
+        flask.g.trace_id = flask.request.headers.get(trace_header) or uuid.uuid4().hex
+
+    @server.after_request
+    def finish_request(response):
+        if not hasattr(flask.g, 'request_start') or flask.request.path == path:
+            return response
+        seconds = time.time() - flask.g.request_start
+        size = response.calculate_content_length() or 0
+        # the route rather than the path, so paths with variables or unknown paths don't add series
+        rule = flask.request.url_rule
+        labels = {'path': rule.rule if rule is not None else 'unmatched', 'output': request_output()}
+        request_seconds.observe(seconds, **labels)
+        response_bytes.observe(size, **labels)
+        response.headers[trace_header] = flask.g.trace_id
+        if trace:
+            print json.dumps(dict(labels, trace_id = flask.g.trace_id, seconds = seconds, bytes = size,
+                                  stages = flask.g.stages), sort_keys = True)
+        return response
+
+    @server.route(path)
+    def metrics():
+        return flask.Response(registry.render(), mimetype = 'text/plain; version=0.0.4')
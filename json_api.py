@@ -0,0 +1,69 @@
+"""
+Encoded JSON responses for the read-only api of the dashboard.
+
+A payload is serialized and gzipped once and kept with its ETag, so serving it again costs
+neither computation nor encoding. Clients sending the ETag back in If-None-Match get an empty
+304 response, and clients accepting gzip get the compressed bytes as they are.
+"""
+import gzip
+import io
+import json
+
+import flask
+import plotly
+
+
+def gzip_bytes(data, level = 6):
+    """ Returns data compressed in the gzip format """
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj = buffer, mode = 'wb', compresslevel = level, mtime = 0) as gzip_file:
+        gzip_file.write(data)
+    return buffer.getvalue()
+
+
+class EncodedPayload:
+    """
+    A value serialized as JSON, plain and gzipped, with the ETag identifying it.
+
+    Args:
+        value: the json serializable value, plotly objects are encoded as well.
+        etag: the strong ETag of the value, such as the key it is stored under.
+    """
+
+    def __init__(self, value, etag):
+        self.etag = etag
+        self.json = json.dumps(value, cls = plotly.utils.PlotlyJSONEncoder)
+        self.gzip = gzip_bytes(self.json)
+
+    @property
+    def nbytes(self):
+        """ Bytes taken by both encodings, for the result store """
+        return len(self.json) + len(self.gzip)
+
+
+def not_modified(etag, version = None):
+    """ Returns an empty 304 response if the request already has the ETag, else None """
+    if not flask.request.if_none_match.contains(etag):
+        return None
+    response = flask.Response(status = 304)
+    return cache_headers(response, etag, version)
+
+
+def payload_response(payload, version = None):
+    """ Returns the response of an EncodedPayload, gzipped if the client accepts it """
+    if 'gzip' in flask.request.accept_encodings:
+        response = flask.Response(payload.gzip, mimetype = 'application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = flask.Response(payload.json, mimetype = 'application/json')
+    return cache_headers(response, payload.etag, version)
+
+
+def cache_headers(response, etag, version = None):
+    """ Sets the ETag and the headers telling clients to revalidate it, and returns the response """
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if version is not None:
+        response.headers['X-Data-Version'] = version
+    return response
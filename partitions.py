@@ -0,0 +1,103 @@
+import datetime
+import json
+import os
+
+import pandas as pd
+
+
+def to_date(day):
+    """ Parses a YYYY-mm-dd string into a date """
+    return datetime.datetime.strptime(day, '%Y-%m-%d').date()
+
+
+def day_range(date_start, date_end):
+    """ Returns every day from date_start to date_end (inclusive) as YYYY-mm-dd strings """
+    start = to_date(date_start)
+    return [(start + datetime.timedelta(i)).strftime('%Y-%m-%d')
+            for i in range((to_date(date_end) - start).days + 1)]
+
+
+def contiguous_ranges(days):
+    """
+    Groups days into ranges of consecutive days.
+
+    Examples:
+        ["2018-09-01", "2018-09-02", "2018-09-05"] becomes
+        [("2018-09-01", "2018-09-02"), ("2018-09-05", "2018-09-05")]
+    """
+    ranges = []
+    for day in sorted(set(days)):
+        if ranges and (to_date(day) - to_date(ranges[-1][1])).days == 1:
+            ranges[-1] = (ranges[-1][0], day)
+        else:
+            ranges.append((day, day))
+    return ranges
+
+
+class PartitionCache:
+    """
+    Local disk cache of extracted data, partitioned by experiment and day.
+
+    Every partition is a pickled data frame holding the rows of one experiment for one day.
+    A manifest records which partitions are final, meaning their day is over and its data
+    will not change anymore, so they never have to be extracted again. The partitions and
+    manifest of every query are kept in a folder named by the hash of the query, so rows of
+    different queries, such as raw and aggregated ones, are never mixed, and switching between
+    queries does not drop the partitions of either.
+
+    Args:
+        path: the folder where the folders of every query are stored.
+        query_hash: a string identifying the query used to extract the data.
+    """
+
+    def __init__(self, path, query_hash):
+        self.path = os.path.join(path, query_hash)
+        self.query_hash = query_hash
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.manifest = self.read_manifest()
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.path, 'manifest.json')
+
+    def partition_path(self, experiment, day):
+        """ Returns the file path of the partition of an experiment and a day """
+        return os.path.join(self.path, experiment, '{}.pkl'.format(day))
+
+    def read_manifest(self):
+        """ Reads the manifest, discarding it if it was written for another query """
+        if os.path.exists(self.manifest_path):
+            manifest = json.load(open(self.manifest_path, 'r'))
+            if manifest.get('query_hash') == self.query_hash:
+                return manifest
+        return {'query_hash': self.query_hash, 'partitions': {}}
+
+    def write_manifest(self):
+        """ Writes the manifest, atomically replacing the previous one """
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.manifest_path)
+
+    def is_final(self, experiment, day):
+        """ Whether the partition is stored and will not change anymore """
+        entry = self.manifest['partitions'].get('{}/{}'.format(experiment, day))
+        return bool(entry and entry['final'] and os.path.exists(self.partition_path(experiment, day)))
+
+    def write(self, experiment, day, df, final):
+        """ Stores the rows of one experiment and day. The manifest is only updated on disk by write_manifest """
+        path = self.partition_path(experiment, day)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        df.to_pickle(path)
+        self.manifest['partitions']['{}/{}'.format(experiment, day)] = {
+            'final': final,
+            'rows': len(df),
+            'extracted_at': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+
+    def read(self, experiment, days):
+        """ Returns the stored partitions of an experiment for the given days, skipping missing ones """
+        paths = [self.partition_path(experiment, day) for day in days]
+        return [pd.read_pickle(path) for path in paths if os.path.exists(path)]
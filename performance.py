@@ -0,0 +1,124 @@
+"""
+Computations behind the two dashboard plots, for every metric at once.
+
+Given the filtered cube, DailyPerformance sums every metric per experiment mode and day in a
+single groupby, and compares every experiment arm to the regular one for every metric with
+stats.ArmComparison. Both plots are built from it, so switching the metric does not compute
+anything again.
+
+The periods of the resolution only shape the plotted series. The totals, their bounds and
+p-values always compare the days, so they don't change with the resolution, and resampling
+gets days as units rather than a handful of weeks or months.
+"""
+import numpy as np
+import pandas as pd
+
+from cube import METRICS, sum_by
+from sequential import SequentialState
+from stats import ArmComparison, CONTROL_MODE
+
+
+# the experiment mode id of the experiment track of a two arm experiment
+EXPERIMENT_MODE = 2
+
+# the columns of ratio_frame that are plotted, in plotting order
+RATIO_LINES = ['performance', '7_day_average_performance', 'total_performance',
+               'total_performance_upperbound', 'total_performance_lowerbound',
+               'always_valid_upperbound', 'always_valid_lowerbound']
+
+
+class DailyPerformance:
+    """
+    Daily metric sums per experiment mode and the arm/regular ratios of a filtered cube.
+
+    Args:
+        df: the filtered cube, with the experimentmodeid, experimentmodename and period columns.
+        metrics: the metrics to compute, by default every metric in df.
+        period: the column of the periods to sum the plotted series by, such as theday or
+            theweek, see rollups.RESOLUTIONS. The series call the periods days and put them
+            in theday. df needs a theday column as well, for the totals.
+        confidence: the coverage of the total performance bounds.
+        resampler: an optional resampling.Resampler. If given, the total performance bounds
+            and p-values come from resampling the days instead of the normal approximation, see
+            resampling.Resampler.compare for experiments with few days.
+        sequential_states: an optional dictionary of sequential.SequentialState by arm, covering
+            the first days of the filtered data. Their always valid bounds are extended with
+            the remaining days, otherwise they are computed from the first day on.
+        tau2: the mixture variance of the always valid bounds, see sequential.msprt_bounds.
+
+    The ratios of an arm only cover the days where both it and the regular track have data.
+    """
+
+    def __init__(self, df, metrics = None, period = 'theday', confidence = 0.95, resampler = None,
+                 sequential_states = None, tau2 = 0.01):
+        self.metrics = metrics or [m for m in METRICS if m in df.columns]
+        self.period = period
+        self.daily = sum_by(df, ['experimentmodeid', 'experimentmodename', period], self.metrics)\
+            .rename(columns = {period: 'theday'})
+        self.comparison = ArmComparison(self.daily, self.metrics, confidence, CONTROL_MODE)
+        # the comparison of the days, behind the totals whatever the period
+        if period == 'theday':
+            self.totals = self.comparison
+        else:
+            days = sum_by(df, ['experimentmodeid', 'experimentmodename', 'theday'], self.metrics)
+            self.totals = ArmComparison(days, self.metrics, confidence, CONTROL_MODE)
+        if resampler is not None:
+            self.bounds = resampler.compare(self.totals)
+        else:
+            self.bounds = dict((key, getattr(self.totals, key)) for key in ['ratio_lower', 'ratio_upper', 'p_value'])
+
+        self.sequential = {}
+        for i, arm in enumerate(self.comparison.arm_ids):
+            state = (sequential_states or {}).get(arm)
+            if state is None or state.metrics != self.metrics:
+                state = SequentialState(self.metrics, 1 - confidence, tau2)
+            matched = self.comparison.matched[i]
+            days = self.comparison.days[matched]
+            new = days > state.last_day if state.last_day is not None else slice(None)
+            # the monitored state keeps appending to its own history, this copy gets a new one
+            self.sequential[arm] = state.extended(list(days[new]), self.comparison.arm_counts[i, matched][new],
+                                                  self.comparison.control_counts[i, matched][new], shared = False)
+
+    @property
+    def arms(self):
+        """ The (experimentmodeid, experimentmodename) of every arm compared to the regular track """
+        return zip(self.comparison.arm_ids, self.comparison.arm_names)
+
+    @property
+    def nbytes(self):
+        """ Approximate memory used by the computed frames and arrays """
+        totals = self.totals.nbytes if self.totals is not self.comparison else 0
+        return int(self.daily.memory_usage(deep = True).sum()) + self.comparison.nbytes + totals
+
+    def mode_series(self, metric):
+        """ Returns a (mode name, days, daily sums) tuple per experiment mode, ordered by mode id """
+        series = []
+        for _, mode_df in self.daily.groupby('experimentmodeid', sort = True):
+            series.append((mode_df['experimentmodename'].iloc[0], mode_df['theday'], mode_df[metric]))
+        return series
+
+    def ratio_frame(self, metric, arm = EXPERIMENT_MODE):
+        """
+        Returns the per day ratio table of a metric for an arm, given by experimentmodeid.
+
+        It has the theday, regular, experiment and total_performance_p_value columns and every
+        column in RATIO_LINES.
+        """
+        comparison = self.comparison
+        i = comparison.arm_index(arm)
+        m = comparison.metrics.index(metric)
+        ratio_df = comparison.series(arm, metric).rename(columns = {'arm': 'experiment', 'control': 'regular',
+                                                                    'ratio': 'performance'})
+        ratio_df['7_day_average_performance'] = ratio_df['experiment'].rolling(7, min_periods = 7).sum() / \
+            ratio_df['regular'].rolling(7, min_periods = 1).sum()
+        t = self.totals.arm_index(arm)
+        ratio_df['total_performance'] = self.totals.ratio[t, m]
+        ratio_df['total_performance_upperbound'] = self.bounds['ratio_upper'][t, m]
+        ratio_df['total_performance_lowerbound'] = self.bounds['ratio_lower'][t, m]
+        ratio_df['total_performance_p_value'] = self.bounds['p_value'][t, m]
+        state = self.sequential[arm]
+        for line, bounds in [('always_valid_upperbound', state.upper), ('always_valid_lowerbound', state.lower)]:
+            # unbounded days are left out of the plot
+            values = pd.Series(bounds[:, m], index = state.days).replace([np.inf, 0], np.nan)
+            ratio_df[line] = values.reindex(ratio_df['theday']).values
+        return ratio_df[['theday', 'regular', 'experiment'] + RATIO_LINES + ['total_performance_p_value']]
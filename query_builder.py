@@ -0,0 +1,84 @@
+"""
+Parameterized GROUP BY queries over the dashboard dimensions and metrics.
+
+The base query (by default sql/base_sql_grouped.sql) selects the dashboard rows and has a
+{} placeholder for its where clause. The builder fills it with the experiment date ranges
+and any extra filters, all as bound parameters, and wraps it in an aggregation so the DB
+returns one row per combination of the group by columns instead of one row per customer.
+
+Column names cannot be bound, so group by columns, metrics and filter columns are checked
+against the known dashboard columns instead.
+"""
+from cube import DIMENSIONS, METRICS
+
+
+# the DB columns the dashboard groups and filters by, thedayunix is only computed in the app
+PUSHDOWN_DIMENSIONS = [d for d in DIMENSIONS if d != 'thedayunix']
+
+
+def check_columns(columns, known):
+    """ Raises a ValueError if any of the columns is not a known column """
+    unknown = [column for column in columns if column not in known]
+    if unknown:
+        raise ValueError("unknown columns for a pushdown query: {}".format(", ".join(unknown)))
+
+
+def build_grouped_query(base_query, date_ranges, filters = None, group_by = PUSHDOWN_DIMENSIONS,
+                        metrics = METRICS, paramstyle = 'pyformat'):
+    """
+    Builds a query summing the metrics per combination of the group by columns.
+
+    Args:
+        base_query: the base SQL text, with a {} placeholder for the where clause.
+        date_ranges: a list of (experiment name, date start, date end) tuples to include.
+        filters: an optional dictionary mapping dimension columns to a value, or to a list of
+            values any of which is accepted. None values and empty lists do not filter.
+        group_by: the dimension columns to group by. If empty, a single row of totals is returned.
+        metrics: the metric columns to sum.
+        paramstyle: 'pyformat' for psycopg2 or 'named' for sqlite3.
+
+    returns:
+        a tuple with the SQL text and the dictionary of parameters to bind.
+
+    Examples:
+        build_grouped_query(base, [('exp1', '2018-09-01', '2018-09-14')],
+                            filters = {'culturekey': ['da-DK', 'en-US'], 'isdesktop': 1},
+                            group_by = ['experimentmodeid', 'theday'], metrics = ['trial'])
+        filters by experiment, date range, culture key and device in the where clause and
+        returns the number of trials per experiment mode and day.
+    """
+    if not date_ranges:
+        raise ValueError("a pushdown query needs at least one experiment date range")
+    filters = dict((column, value) for column, value in (filters or {}).items()
+                   if value is not None and value != [])
+    check_columns(group_by, PUSHDOWN_DIMENSIONS)
+    check_columns(filters.keys(), PUSHDOWN_DIMENSIONS)
+    check_columns(metrics, METRICS)
+
+    params = {}
+
+    def bind(name, value):
+        params[name] = value
+        return '%({})s'.format(name) if paramstyle == 'pyformat' else ':{}'.format(name)
+
+    ranges = []
+    for i, (exp_name, date_start, date_end) in enumerate(date_ranges):
+        ranges.append("(theday >= {} and theday <= {} and experimenttypename = {})".format(
+            bind('date_start_{}'.format(i), date_start),
+            bind('date_end_{}'.format(i), date_end),
+            bind('experiment_{}'.format(i), exp_name)))
+    predicates = ["({})".format(" or \n".join(ranges))]
+
+    for column, value in sorted(filters.items()):
+        if isinstance(value, (list, tuple)):
+            values = [bind('{}_{}'.format(column, i), v) for i, v in enumerate(value)]
+            predicates.append("{} in ({})".format(column, ", ".join(values)))
+        else:
+            predicates.append("{} = {}".format(column, bind(column, value)))
+
+    columns = list(group_by) + ["sum({0}) as {0}".format(metric) for metric in metrics]
+    query = "select {}\nfrom ({}) as base".format(", ".join(columns), base_query.format(" and \n".join(predicates)))
+    if group_by:
+        query += "\ngroup by {}".format(", ".join(group_by))
+
+    return query, params
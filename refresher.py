@@ -0,0 +1,103 @@
+import atexit
+import threading
+import time
+
+
+def next_run_time(now, interval, offset):
+    """
+    Returns the first time after now that is offset seconds past a multiple of interval.
+
+    Examples:
+        with an interval of 30 minutes and an offset of 5 minutes, runs happen at
+        hh:05 and hh:35 (in UTC, since unix times are aligned to it).
+    """
+    return (int(now - offset) // interval + 1) * interval + offset
+
+
+class RefreshScheduler:
+    """
+    Background thread that refreshes the data store on a fixed cadence.
+
+    Each run loads the data and builds its derived structures off the request path, and the
+    data store swaps the new snapshot in atomically, so requests never wait for the DB.
+    Runs are aligned to the clock, so they can be scheduled right after the upstream table
+    is rebuilt, and every worker of a node fires at the same time: the first one refreshes
+    while the others wait for it and pick up its snapshot.
+
+    Args:
+        data_store: the data_store.DataStore to refresh.
+        read_params: a function without arguments returning the current experiment configuration.
+        loader: a function taking the experiment configuration and returning the raw data frame.
+        interval: seconds between runs.
+        offset: seconds past each multiple of interval at which the runs happen.
+    """
+
+    def __init__(self, data_store, read_params, loader, interval, offset = 0):
+        self.data_store = data_store
+        self.read_params = read_params
+        self.loader = loader
+        self.interval = interval
+        self.offset = offset
+        self.last_refresh = None
+        self.last_duration = None
+        self.last_error = None
+        self.next_refresh = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self, warm = True):
+        """ Starts the background thread, refreshing right away first if warm is set """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target = self.run, args = (warm,))
+        self._thread.daemon = True
+        self._thread.start()
+        # wake the thread up before the interpreter tears its modules down
+        atexit.register(self.stop)
+
+    def stop(self, timeout = 1):
+        """ Stops the background thread, waiting up to timeout seconds for its current run """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self, warm = True):
+        """ Refreshes the data store on the cadence until stopped """
+        if warm:
+            self.refresh_once()
+        while not self._stop.is_set():
+            self.next_refresh = next_run_time(time.time(), self.interval, self.offset)
+            self._stop.wait(max(0, self.next_refresh - time.time()))
+            if not self._stop.is_set():
+                self.refresh_once(newer_than = self.next_refresh)
+
+    def refresh_once(self, newer_than = None):
+        """
+        Refreshes the data store, keeping the previous data if it fails.
+
+        Args:
+            newer_than: unix time the data has to be loaded after, by default any data that has
+                not expired is kept.
+        """
+        start = time.time()
+        try:
+            exp_params = self.read_params()
+            self.data_store.refresh(exp_params, lambda: self.loader(exp_params), newer_than = newer_than)
+            self.last_error = None
+        except Exception as e:
+            self.last_error = str(e)
+            print "scheduled refresh failed, serving the previous data: {}".format(e)
+        self.last_refresh = start
+        self.last_duration = time.time() - start
+
+    def status(self):
+        """ Returns a json serializable summary of the scheduler state """
+        return {
+            'version': self.data_store.version,
+            'last_refresh': self.last_refresh,
+            'last_refresh_duration': self.last_duration,
+            'last_error': self.last_error,
+            'next_refresh': self.next_refresh,
+            'interval': self.interval,
+            'offset': self.offset
+        }
@@ -0,0 +1,116 @@
+"""
+Batch report of the dashboard ratios for every experiment and metric.
+
+The rows are summed per experiment, arm and day once, and every experiment is then handed to
+a worker of a process pool that builds its performance.DailyPerformance, the same computation
+behind the ratio plot, so the report has the numbers the dashboard shows for the whole date
+range of every experiment without any filter.
+
+The report has one row per experiment, arm, metric and day, plus a row with 'total' as theday
+per experiment, arm and metric:
+    regular, experiment: the metric sums of the regular track and of the arm.
+    performance: the arm/regular ratio of the day, or of the whole experiment on total rows.
+    7_day_average_performance: the ratio of the last 7 days, left empty on total rows.
+    lowerbound, upperbound, p_value: the confidence bounds and p-value of the total ratio,
+        only set on total rows.
+    always_valid_lowerbound, always_valid_upperbound: the always valid bounds as of the day,
+        and as of the last day on total rows.
+Ratios are given as they are, a ratio of 1.05 is the +5% of the dashboard.
+"""
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from cube import METRICS, sum_by
+from performance import DailyPerformance
+from resampling import Resampler
+
+
+REPORT_COLUMNS = ['experimenttypename', 'experimentmodeid', 'experimentmodename', 'metric', 'theday',
+                  'regular', 'experiment', 'performance', '7_day_average_performance',
+                  'lowerbound', 'upperbound', 'p_value', 'always_valid_lowerbound', 'always_valid_upperbound']
+
+
+def arm_report(performance, arm, metric):
+    """ Returns the report rows of one arm and metric of a performance.DailyPerformance, without the experiment """
+    days = performance.ratio_frame(metric, arm)
+    rows = days[['theday', 'regular', 'experiment', 'performance', '7_day_average_performance',
+                 'always_valid_lowerbound', 'always_valid_upperbound']].copy()
+
+    comparison = performance.totals
+    i, m = comparison.arm_index(arm), comparison.metrics.index(metric)
+    last = days.iloc[-1] if len(days) else {}
+    total = OrderedDict([('theday', 'total'),
+                         ('regular', comparison.control_total[i, m]),
+                         ('experiment', comparison.arm_total[i, m]),
+                         ('performance', comparison.ratio[i, m]),
+                         ('lowerbound', performance.bounds['ratio_lower'][i, m]),
+                         ('upperbound', performance.bounds['ratio_upper'][i, m]),
+                         ('p_value', performance.bounds['p_value'][i, m]),
+                         ('always_valid_lowerbound', last.get('always_valid_lowerbound', np.nan)),
+                         ('always_valid_upperbound', last.get('always_valid_upperbound', np.nan))])
+    return pd.concat([rows, pd.DataFrame([total])], ignore_index = True, sort = False)
+
+
+def report_experiment(task):
+    """
+    Returns the report rows of one experiment.
+
+    Args:
+        task: a (experiment, daily sums, metrics, confidence, resamples, seed, tau2) tuple, as
+            a tuple so it can go through Pool.map. resamples can be 0 to use the normal
+            approximation for the bounds of the totals.
+    """
+    experiment, daily, metrics, confidence, resamples, seed, tau2 = task
+    resampler = Resampler(resamples, confidence, seed = seed) if resamples else None
+    performance = DailyPerformance(daily, metrics, confidence = confidence, resampler = resampler, tau2 = tau2)
+
+    frames = []
+    for arm, arm_name in performance.arms:
+        for metric in performance.metrics:
+            rows = arm_report(performance, arm, metric)
+            rows.insert(0, 'metric', metric)
+            rows.insert(0, 'experimentmodename', arm_name)
+            rows.insert(0, 'experimentmodeid', arm)
+            rows.insert(0, 'experimenttypename', experiment)
+            frames.append(rows)
+    return pd.concat(frames, ignore_index = True)[REPORT_COLUMNS] if frames else pd.DataFrame(columns = REPORT_COLUMNS)
+
+
+def experiment_report(df, metrics = None, confidence = 0.95, resamples = 2000, seed = 0, tau2 = 0.01, processes = 1):
+    """
+    Returns the report of every experiment in df, see the module docstring for its columns.
+
+    Args:
+        df: the dashboard rows or the cube, with the experimenttypename, experimentmodeid,
+            experimentmodename and theday columns.
+        metrics: the metrics to report, by default every metric in df.
+        confidence: the coverage of the bounds.
+        resamples: how many bootstrap resamples of the days the total bounds come from, as in
+            the dashboard. 0 uses the normal approximation instead.
+        seed: the seed of the resamples, the dashboard uses 0 as well.
+        tau2: the mixture variance of the always valid bounds.
+        processes: how many experiments are computed at the same time, in a process pool.
+    """
+    metrics = metrics or [m for m in METRICS if m in df.columns]
+    daily = sum_by(df, ['experimenttypename', 'experimentmodeid', 'experimentmodename', 'theday'], metrics)
+    daily['theday'] = pd.to_datetime(daily['theday']).dt.strftime('%Y-%m-%d')
+
+    # only the daily sums go to the workers, they are tiny compared to the rows
+    tasks = [(experiment, experiment_daily.drop('experimenttypename', axis = 1), metrics, confidence, resamples, seed, tau2)
+             for experiment, experiment_daily in daily.groupby(daily['experimenttypename'].astype(str), sort = True)]
+    if processes > 1 and len(tasks) > 1:
+        pool = Pool(min(processes, len(tasks)))
+        try:
+            frames = pool.map(report_experiment, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        frames = map(report_experiment, tasks)
+
+    if not frames:
+        return pd.DataFrame(columns = REPORT_COLUMNS)
+    return pd.concat(frames, ignore_index = True)
@@ -0,0 +1,178 @@
+"""
+Bootstrap and permutation inference for the arm/control ratios, from summed units.
+
+A unit is a row of metric sums, such as the sums of a day or of a cube cell. Resamples are
+drawn in batches of whole matrices: a batch of bootstrap resamples is a matrix of unit
+weights and a batch of permutations is a matrix of unit labels, so the resampled totals of
+every metric come out of one matrix product per batch. Every batch has its own seed derived
+from the resampler's seed, so a seeded resampler gives the same results whether the batches
+run in this process or in a process pool.
+
+Resampling needs enough units to see their variability: the bootstrap of a few days whose
+ratios happen to be close gives an interval far too narrow, and the permutation p-value of a
+few days cannot get small. Below a minimum number of units neither is computed.
+"""
+import warnings
+from multiprocessing import Pool
+
+import numpy as np
+
+
+# the fewest units, such as days, that are resampled
+MIN_UNITS = 10
+
+
+def batch_seeds(seed, batches):
+    """ Returns a seed per batch, derived from seed, or None seeds if seed is None """
+    if seed is None:
+        return [None] * batches
+    return list(np.random.RandomState(seed).randint(0, 2 ** 31 - 1, batches))
+
+
+def bootstrap_weights(random, size, units):
+    """ Returns a (size, units) matrix with how many times each resample draws each unit """
+    draws = random.randint(0, units, (size, units)) + units * np.arange(size)[:, None]
+    return np.bincount(draws.ravel(), minlength = size * units).reshape(size, units)
+
+
+def bootstrap_batch(args):
+    """ Returns the (size, metrics) resampled ratios of the arm and control unit sums """
+    arm, control, paired, size, seed = args
+    random = np.random.RandomState(seed)
+    arm_weights = bootstrap_weights(random, size, len(arm))
+    control_weights = arm_weights if paired else bootstrap_weights(random, size, len(control))
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return arm_weights.dot(arm) / control_weights.dot(control)
+
+
+def permutation_batch(args):
+    """ Returns the (size, metrics) ratios of the arm and control unit sums with shuffled arm labels """
+    arm, control, paired, size, seed = args
+    random = np.random.RandomState(seed)
+    if paired:
+        # swaps the arm and control sums of a random half of the units
+        swaps = random.rand(size, len(arm)) < 0.5
+        moved = swaps.dot(arm - control)
+        arm_sums = arm.sum(axis = 0) - moved
+        control_sums = control.sum(axis = 0) + moved
+    else:
+        # hands the arm label to a random subset of the pooled units, as many as the arm had
+        pooled = np.concatenate([arm, control])
+        chosen = np.argsort(random.rand(size, len(pooled)), axis = 1)[:, :len(arm)]
+        labels = np.zeros((size, len(pooled)))
+        labels[np.arange(size)[:, None], chosen] = 1
+        arm_sums = labels.dot(pooled)
+        control_sums = pooled.sum(axis = 0) - arm_sums
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return arm_sums / control_sums
+
+
+class Resampler:
+    """
+    Bootstrap confidence intervals and permutation p-values for ratios of summed metrics.
+
+    Args:
+        resamples: the number of bootstrap resamples or permutations.
+        confidence: the coverage of the bootstrap percentile intervals.
+        seed: the seed of the draws. If given, the results are deterministic, otherwise every
+            call draws anew.
+        processes: the number of processes the batches are spread over. With 1 or less they
+            run in this process.
+        batch_size: the number of resamples drawn at a time, bounding the memory of a batch.
+        min_units: the fewest units of an arm that are resampled, see the module docstring.
+    """
+
+    def __init__(self, resamples = 2000, confidence = 0.95, seed = None, processes = 1, batch_size = 500,
+                 min_units = MIN_UNITS):
+        self.resamples = resamples
+        self.confidence = confidence
+        self.seed = seed
+        self.processes = processes
+        self.batch_size = batch_size
+        self.min_units = min_units
+        self._pool = None
+
+    def run(self, batch, arm, control, paired):
+        """ Returns the stacked results of batch over all the resamples """
+        arm = np.asarray(arm, dtype = float)
+        control = np.asarray(control, dtype = float)
+        sizes = [min(self.batch_size, self.resamples - start) for start in range(0, self.resamples, self.batch_size)]
+        tasks = [(arm, control, paired, size, seed) for size, seed in zip(sizes, batch_seeds(self.seed, len(sizes)))]
+        if self.processes > 1 and len(tasks) > 1:
+            if self._pool is None:
+                self._pool = Pool(self.processes)
+            results = self._pool.map(batch, tasks)
+        else:
+            results = [batch(task) for task in tasks]
+        return np.concatenate(results)
+
+    def bootstrap(self, arm, control, paired = True):
+        """
+        Returns the lower and upper percentile bootstrap bounds of the ratios of the summed units.
+
+        Args:
+            arm: the (units, metrics) sums of the arm.
+            control: the (units, metrics) sums of the control arm.
+            paired: whether the units of both arms are paired, such as the same days, and are
+                drawn together. Otherwise each arm's units are drawn on their own.
+
+        Ratios with fewer than min_units units in an arm get nan bounds.
+        """
+        metrics = np.shape(arm)[1]
+        if len(arm) < self.min_units or len(control) < self.min_units:
+            return np.full(metrics, np.nan), np.full(metrics, np.nan)
+        ratios = self.run(bootstrap_batch, arm, control, paired)
+        ratios[~np.isfinite(ratios)] = np.nan
+        alpha = (1 - self.confidence) / 2 * 100
+        with warnings.catch_warnings():
+            # metrics without a single finite ratio get nan bounds
+            warnings.simplefilter('ignore', RuntimeWarning)
+            lower, upper = np.nanpercentile(ratios, [alpha, 100 - alpha], axis = 0)
+        return lower, upper
+
+    def permutation(self, arm, control, paired = True):
+        """
+        Returns the two sided permutation p-values of the ratios of the summed units against 1.
+
+        The arguments are the same as for bootstrap. Paired units are permuted by swapping the
+        arms within units, unpaired units by shuffling the arm labels over all units. Ratios
+        with fewer than min_units units in an arm get nan p-values.
+        """
+        arm = np.asarray(arm, dtype = float)
+        control = np.asarray(control, dtype = float)
+        if len(arm) < self.min_units or len(control) < self.min_units:
+            return np.full(np.shape(arm)[1], np.nan)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            observed = np.abs(np.log(arm.sum(axis = 0) / control.sum(axis = 0)))
+            resampled = np.abs(np.log(self.run(permutation_batch, arm, control, paired)))
+            extreme = (resampled >= observed - 1e-12).sum(axis = 0)
+        return np.where(np.isfinite(observed), (extreme + 1.0) / (self.resamples + 1), np.nan)
+
+    def compare(self, comparison):
+        """
+        Resamples the days of every arm of a stats.ArmComparison, paired with the control days.
+
+        Arms with fewer than min_units days keep the delta method bounds of the comparison and
+        get nan p-values, as there is no reliable p-value for so few days.
+
+        returns:
+            a dictionary with the ratio_lower, ratio_upper and p_value arrays, shaped (arms, metrics).
+        """
+        shape = comparison.ratio.shape
+        result = dict((key, np.full(shape, np.nan)) for key in ['ratio_lower', 'ratio_upper', 'p_value'])
+        for i in range(len(comparison.arm_ids)):
+            matched = comparison.matched[i]
+            arm = comparison.arm_counts[i, matched]
+            control = comparison.control_counts[i, matched]
+            if len(arm) < self.min_units:
+                result['ratio_lower'][i], result['ratio_upper'][i] = comparison.ratio_lower[i], comparison.ratio_upper[i]
+                continue
+            result['ratio_lower'][i], result['ratio_upper'][i] = self.bootstrap(arm, control)
+            result['p_value'][i] = self.permutation(arm, control)
+        return result
+
+    def close(self):
+        """ Closes the process pool, if any """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import sys
+import threading
+from collections import OrderedDict
+
+
+def result_key(*parts):
+    """ Returns a short key identifying the given json serializable parts """
+    return hashlib.md5(json.dumps(parts, sort_keys=True, default=str)).hexdigest()[:16]
+
+
+def result_size(value):
+    """
+    Estimates how many bytes a stored value takes in memory.
+
+    Frames are measured by pandas, arrays and objects with an nbytes attribute by it, and
+    dicts, lists and tuples, such as plain figures, by the size of the containers and of
+    everything they hold. Values referenced more than once are counted every time.
+    """
+    if hasattr(value, 'memory_usage'):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(result_size(k) + result_size(v) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(result_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class ResultStore:
+    """
+    Server side store for intermediate callback results, such as filtered data frames and figures.
+
+    Entries are evicted in least recently used order whenever the total estimated size of
+    the stored values goes above max_bytes. Values are handed out as they were stored, so
+    callers must treat them as read only.
+
+    Args:
+        max_bytes: the memory budget for all stored values together.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """ Returns the value stored under key, or None if there is none """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            value, size = self._entries.pop(key)
+            self._entries[key] = (value, size)
+            return value
+
+    def put(self, key, value):
+        """ Stores value under key, evicting the least recently used values if needed """
+        size = result_size(value)
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            # never evict the value that was just stored, even if it is larger than the budget
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+        return value
+
+    def get_or_compute(self, key, compute):
+        """ Returns the value stored under key, calling compute() and storing its result on a miss """
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, compute())
+        return value
+
+    def clear(self):
+        """ Removes every stored value """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
@@ -0,0 +1,67 @@
+"""
+Time resolutions of the dashboard series.
+
+The daily cube is rolled up to weeks and months by labeling every cube cell with the week
+and month of its day, so a coarser series is a group by of the same filtered cube over a
+different column. Hourly series come from a separate cube that keeps thehour as a dimension,
+since it has up to 24 times as many cells. The resolution of a date range is the coarsest one
+that still gives at least a minimum number of points.
+"""
+from collections import OrderedDict
+
+import pandas as pd
+
+from cube import DIMENSIONS, build_cube
+
+
+# the period column of every resolution, from the finest to the coarsest
+RESOLUTIONS = OrderedDict([('hour', 'thehour'), ('day', 'theday'), ('week', 'theweek'), ('month', 'themonth')])
+
+# the length of a period of every resolution, months are taken on average
+PERIOD_SECONDS = {'hour': 3600, 'day': 86400, 'week': 7 * 86400, 'month': 30.44 * 86400}
+
+# the dimensions of the hourly cube
+HOURLY_DIMENSIONS = DIMENSIONS + ['thehour']
+
+
+def add_periods(cube):
+    """
+    Adds the theweek and themonth columns to a cube with a theday column, and returns it.
+
+    Weeks are labeled by their monday and months by their first day, both as YYYY-mm-dd. The
+    labels are computed once per distinct day and mapped to the cells.
+    """
+    days = pd.Series(cube['theday'].unique())
+    dates = pd.to_datetime(days)
+    weeks = (dates - pd.to_timedelta(dates.dt.dayofweek, unit = 'd')).dt.strftime('%Y-%m-%d')
+    months = dates.dt.strftime('%Y-%m-01')
+    cube['theweek'] = cube['theday'].map(dict(zip(days, weeks)))
+    cube['themonth'] = cube['theday'].map(dict(zip(days, months)))
+    return cube
+
+
+def build_hourly_cube(df):
+    """ Returns the cube with thehour as a dimension, or None if the data has no thehour column """
+    if 'thehour' not in df.columns:
+        return None
+    return build_cube(df, HOURLY_DIMENSIONS)
+
+
+def pick_resolution(start, end, available, min_points = 20):
+    """
+    Returns the coarsest resolution giving at least min_points periods between two unix times.
+
+    Args:
+        start: the unix time of the first day.
+        end: the unix time of the last day, which is included.
+        available: the resolutions to choose from.
+        min_points: the number of periods the resolution needs to give.
+
+    If no resolution gives enough periods, the finest available one is returned.
+    """
+    span = end - start + PERIOD_SECONDS['day']
+    available = [resolution for resolution in RESOLUTIONS if resolution in available]
+    for resolution in reversed(available):
+        if span / PERIOD_SECONDS[resolution] >= min_points:
+            return resolution
+    return available[0]
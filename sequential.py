@@ -0,0 +1,304 @@
+"""
+Always valid inference for the arm/control count ratios, updated one day at a time.
+
+The bounds come from a mixture sequential probability ratio test (mSPRT) on the logarithm of
+the ratio, with a normal mixture of variance tau2 over the alternatives. Unlike the fixed
+horizon intervals of stats, they stay valid however often the experiment is looked at and
+whenever it is stopped: the running interval is the intersection of the intervals of every
+day so far, and the running p-value is the smallest one so far.
+
+A SequentialState holds the running sums and bounds of one arm for every metric, so adding
+days only costs the new days. The bounds of every day are kept in a History, which the states
+extended from one another share and append to. The SequentialMonitor keeps a state per
+experiment, arm and segment across data refreshes and only feeds them the final days they
+have not seen, which it finds by binary search in the day sorted filter index.
+"""
+import copy
+import datetime
+import threading
+
+import numpy as np
+import pandas as pd
+
+from cube import METRICS, sum_by
+from stats import CONTROL_MODE
+
+
+# the segment key of the states covering every segment
+ALL_SEGMENTS = None
+
+
+def msprt_bounds(arm, control, alpha, tau2):
+    """
+    Returns the mSPRT interval bounds and p-values of the ratios of cumulative counts.
+
+    Args:
+        arm: the cumulative counts of the arm.
+        control: the cumulative counts of the control arm, shaped like arm.
+        alpha: one minus the coverage of the intervals.
+        tau2: the variance of the normal mixture over the logarithm of the ratio.
+
+    Counts without data in both arms get the uninformative (0, inf) interval and a p-value of 1.
+    """
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        estimate = np.log(arm / control)
+        variance = 1 / arm + 1 / control
+        half = np.sqrt(variance * (variance + tau2) / tau2 * (2 * np.log(1 / alpha) + np.log((variance + tau2) / variance)))
+        lower = np.exp(estimate - half)
+        upper = np.exp(estimate + half)
+        log_likelihood_ratio = 0.5 * np.log(variance / (variance + tau2)) + \
+            tau2 * estimate ** 2 / (2 * variance * (variance + tau2))
+        p_value = np.minimum(1, np.exp(-log_likelihood_ratio))
+    valid = np.isfinite(estimate) & np.isfinite(variance)
+    return np.where(valid, lower, 0), np.where(valid, upper, np.inf), np.where(valid, p_value, 1)
+
+
+def running(previous, values, ufunc):
+    """ Returns the running ufunc (np.maximum or np.minimum) of values, continuing from the last row of previous """
+    last = previous[-1:]
+    return ufunc.accumulate(np.vstack([last, values]), axis = 0)[len(last):]
+
+
+def day_unix(day):
+    """ Returns the unix time of the midnight of a day, like thedayunix """
+    return pd.Timestamp(day).value // 10**9
+
+
+class History:
+    """
+    Append-only days and running bounds, shared by the states extended from one another.
+
+    A state only sees the first rows of the history, up to its own size. A state ending where
+    the history ends appends to it in place, in amortized constant time per row, while a state
+    that others have extended past copies its rows into a new history first. Readers of a
+    state are never affected by later appends, which only write rows after theirs.
+
+    Args:
+        columns: the number of metrics.
+        capacity: the number of rows allocated up front.
+    """
+
+    def __init__(self, columns, capacity = 64):
+        self.days = np.empty(capacity, dtype = object)
+        self.lower = np.zeros((capacity, columns))
+        self.upper = np.zeros((capacity, columns))
+        self.p_value = np.zeros((capacity, columns))
+        self.size = 0
+        self.lock = threading.Lock()
+
+    @property
+    def capacity(self):
+        return len(self.days)
+
+    def copy(self, size, capacity):
+        """ Returns a new history with the first size rows of this one and room for capacity rows """
+        history = History(self.lower.shape[1], capacity)
+        for name in ['days', 'lower', 'upper', 'p_value']:
+            getattr(history, name)[:size] = getattr(self, name)[:size]
+        history.size = size
+        return history
+
+    def append(self, size, days, lower, upper, p_value):
+        """
+        Adds rows after the first size ones, and returns the history holding them.
+
+        That is this history if it ends at size and has room, otherwise a copy of its first
+        size rows with room for twice as many rows.
+        """
+        with self.lock:
+            end = size + len(days)
+            if self.size == size and end <= self.capacity:
+                history = self
+            else:
+                history = self.copy(size, max(2 * end, 64))
+            history.days[size:end] = days
+            history.lower[size:end] = lower
+            history.upper[size:end] = upper
+            history.p_value[size:end] = p_value
+            history.size = end
+        return history
+
+
+class SequentialState:
+    """
+    The running always valid bounds of one arm against the control arm, for every metric.
+
+    Args:
+        metrics: the metrics the sums are given for.
+        alpha: one minus the coverage of the intervals.
+        tau2: the variance of the normal mixture over the logarithm of the ratio.
+
+    The days, in order, and the running lower, upper and p_value arrays, shaped (days,
+    metrics), hold the bounds as of every day added so far. They are read only views of the
+    history of the state.
+    """
+
+    def __init__(self, metrics = METRICS, alpha = 0.05, tau2 = 0.01):
+        self.metrics = list(metrics)
+        self.alpha = alpha
+        self.tau2 = tau2
+        self.arm_total = np.zeros(len(self.metrics))
+        self.control_total = np.zeros(len(self.metrics))
+        self.size = 0
+        self.history = History(len(self.metrics))
+
+    @property
+    def days(self):
+        return self.history.days[:self.size]
+
+    @property
+    def lower(self):
+        return self.history.lower[:self.size]
+
+    @property
+    def upper(self):
+        return self.history.upper[:self.size]
+
+    @property
+    def p_value(self):
+        return self.history.p_value[:self.size]
+
+    @property
+    def last_day(self):
+        """ The last day added, or None if there is none """
+        return self.history.days[self.size - 1] if self.size else None
+
+    def update(self, days, arm, control):
+        """
+        Adds days after the last one, with the (days, metrics) sums of the arm and of the control arm.
+
+        Only the new days are computed: their cumulative sums continue the running totals and
+        their bounds are intersected with the last running bounds.
+        """
+        if not len(days):
+            return self
+        arm_cumulative = self.arm_total + np.cumsum(arm, axis = 0)
+        control_cumulative = self.control_total + np.cumsum(control, axis = 0)
+        lower, upper, p_value = msprt_bounds(arm_cumulative, control_cumulative, self.alpha, self.tau2)
+
+        self.history = self.history.append(self.size, days, running(self.lower, lower, np.maximum),
+                                           running(self.upper, upper, np.minimum),
+                                           running(self.p_value, p_value, np.minimum))
+        self.size += len(days)
+        self.arm_total = arm_cumulative[-1]
+        self.control_total = control_cumulative[-1]
+        return self
+
+    def extended(self, days, arm, control, shared = True):
+        """
+        Returns a copy of this state with the days added, leaving this state as is.
+
+        Args:
+            days, arm, control: the days to add and their sums, see update.
+            shared: whether the copy may append to the history of this state in place. Short
+                lived copies, such as the ones of a single request, pass False and copy the
+                history instead, so the long lived chain of states keeps appending in place.
+        """
+        state = copy.copy(self)
+        if not shared:
+            state.history = self.history.copy(self.size, self.size + len(days))
+        return state.update(days, arm, control)
+
+
+def final_day(today = None):
+    """ Returns the last day whose data cannot change anymore, days before yesterday are final """
+    today = today or datetime.date.today()
+    return (today - datetime.timedelta(2)).strftime('%Y-%m-%d')
+
+
+class SequentialMonitor:
+    """
+    Keeps a SequentialState per experiment, arm and segment across data refreshes.
+
+    Args:
+        metrics: the metrics to monitor.
+        alpha: one minus the coverage of the intervals.
+        tau2: the variance of the normal mixture over the logarithm of the ratio.
+        segment_column: the column the states are split by. Every experiment and arm also
+            has a state over all of its segments, under ALL_SEGMENTS.
+
+    Each update only reads and aggregates the final days after the ones the experiment's
+    states have seen, found by binary search in the filter index, and the states only append
+    them to their history. Days that are not final yet are left to the callers, who extend a
+    copy of the state with them. If the first day of an experiment changes, for instance because its
+    configuration did, its states start over.
+    """
+
+    def __init__(self, metrics = METRICS, alpha = 0.05, tau2 = 0.01, segment_column = 'segment'):
+        self.metrics = list(metrics)
+        self.alpha = alpha
+        self.tau2 = tau2
+        self.segment_column = segment_column
+        self.states = {}
+        self.first_days = {}
+        self.last_days = {}
+        self._lock = threading.Lock()
+
+    def arm_states(self, experiment, segment = ALL_SEGMENTS):
+        """ Returns the states of an experiment and segment, by arm (experimentmodeid) """
+        with self._lock:
+            return dict((arm, state) for (state_experiment, arm, state_segment), state in self.states.items()
+                        if state_experiment == experiment and state_segment == segment)
+
+    def update(self, index, last_day = None):
+        """
+        Feeds the states the final days of the index they have not seen yet, and returns this monitor.
+
+        Args:
+            index: a filter_index.FilterIndex over the cube, with the experimenttypename,
+                experimentmodeid, theday, thedayunix and segment columns and the metrics. Its
+                rows are sorted by experiment and day.
+            last_day: the last final day, see final_day.
+        """
+        last_day = last_day or final_day()
+        days = index.data['theday']
+        with self._lock:
+            frames = []
+            for experiment, (start, end) in index.experiment_rows.items():
+                if start == end:
+                    continue
+                if self.first_days.get(experiment) != days.iat[start]:
+                    self.reset(experiment)
+                    self.first_days[experiment] = days.iat[start]
+
+                experiment_days = index.days[start:end]
+                seen = self.last_days.get(experiment)
+                new_start = start + (np.searchsorted(experiment_days, day_unix(seen), side = 'right') if seen else 0)
+                new_end = start + np.searchsorted(experiment_days, day_unix(last_day), side = 'right')
+                if new_start < new_end:
+                    frames.append(index.data.iloc[new_start:new_end])
+                    self.last_days[experiment] = days.iat[new_end - 1]
+
+            if frames:
+                new_rows = pd.concat(frames, ignore_index = True)
+                self.add(sum_by(new_rows, ['experimenttypename', 'experimentmodeid', 'theday'], self.metrics), ALL_SEGMENTS)
+                self.add(sum_by(new_rows, ['experimenttypename', self.segment_column, 'experimentmodeid', 'theday'],
+                                self.metrics), self.segment_column)
+        return self
+
+    def add(self, daily, segment_column):
+        """ Adds the daily sums per experiment, (segment,) arm and day to the states, in day order """
+        keys = ['experimenttypename'] + ([segment_column] if segment_column else [])
+        for key, key_daily in daily.groupby([daily[column].astype(str) for column in keys]):
+            experiment, segment = (key, ALL_SEGMENTS) if not segment_column else key
+            # arms are compared on the days the control arm has data as well
+            by_arm = key_daily.set_index(['theday', 'experimentmodeid'])[self.metrics].unstack('experimentmodeid')
+            if CONTROL_MODE not in by_arm.columns.get_level_values(1):
+                continue
+            control = by_arm.xs(CONTROL_MODE, axis = 1, level = 1)
+            for arm in by_arm.columns.get_level_values(1).unique():
+                if arm == CONTROL_MODE:
+                    continue
+                arm_sums = by_arm.xs(arm, axis = 1, level = 1)
+                matched = arm_sums.notnull().all(axis = 1) & control.notnull().all(axis = 1)
+                state = self.states.get((experiment, arm, segment)) or SequentialState(self.metrics, self.alpha, self.tau2)
+                # states are replaced rather than changed, so readers of the previous one are not affected
+                self.states[(experiment, arm, segment)] = \
+                    state.extended(list(arm_sums.index[matched]), arm_sums[matched].values, control[matched].values)
+
+    def reset(self, experiment):
+        """ Drops every state of an experiment """
+        for key in [key for key in self.states if key[0] == experiment]:
+            del self.states[key]
+        self.first_days.pop(experiment, None)
+        self.last_days.pop(experiment, None)
@@ -0,0 +1,184 @@
+"""
+Columnar on-disk snapshots of the dashboard data.
+
+A snapshot is a folder holding one NumPy .npy file per column plus a meta.json file with
+the column types, the categories of the categorical columns and any extra metadata given
+by the writer. Columns are loaded with memory mapping and the frame is built over the mapped
+arrays without copying them, see frame_from_columns, so the numeric and categorical columns
+of every worker on a node are the same pages of the OS page cache.
+
+Text columns are stored as integer codes and their distinct values, the columns in
+data_store.CATEGORICAL_COLUMNS come back as categoricals over the mapped codes. Other text
+columns, such as theday, come back as plain strings, which takes an array of pointers to the
+distinct values on the heap of every worker.
+
+The .npy files are what np.load maps directly. pyarrow, used for the parquet and feather
+outputs of the data extractor, would copy the columns into pandas on every read.
+"""
+import json
+import os
+import shutil
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+from pandas.core.internals import BlockManager, make_block
+
+from data_store import CATEGORICAL_COLUMNS
+from instrumentation import timed
+
+
+def frame_from_columns(columns):
+    """
+    Returns a data frame over a list of (name, values) columns without copying the values.
+
+    pd.DataFrame would consolidate the columns of the same type into new 2D blocks, copying
+    memory mapped arrays onto the heap. Here every column gets its own block over its array, and
+    the frame is marked as consolidated so pandas does not merge the blocks later on.
+    """
+    blocks = []
+    for i, (name, values) in enumerate(columns):
+        # categoricals are one dimensional blocks, the other blocks have one row per column
+        values = values if isinstance(values, pd.Categorical) else values.reshape(1, -1)
+        blocks.append(make_block(values, placement = [i]))
+    length = len(columns[0][1]) if columns else 0
+    manager = BlockManager(blocks, [pd.Index([name for name, _ in columns]), pd.RangeIndex(length)])
+    manager._is_consolidated = True
+    manager._known_consolidated = True
+    return pd.DataFrame(manager)
+
+
+class SnapshotStore:
+    """
+    Folder of versioned snapshots, with a pointer file naming the current one.
+
+    New snapshots are written to a temporary folder that is renamed into place, and the
+    pointer is then replaced atomically, so readers never see a partially written snapshot.
+    The previous snapshots are kept, up to keep of them, since other workers may still be
+    reading them.
+
+    Args:
+        path: the folder where the snapshots are stored.
+        keep: how many snapshots to keep on disk, including the current one.
+    """
+
+    def __init__(self, path, keep = 2):
+        self.path = path
+        self.keep = keep
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    @property
+    def pointer_path(self):
+        return os.path.join(self.path, 'CURRENT')
+
+    def current(self):
+        """ Returns the folder of the current snapshot, or None if there is none """
+        if not os.path.exists(self.pointer_path):
+            return None
+        folder = os.path.join(self.path, open(self.pointer_path, 'r').read().strip())
+        return folder if os.path.exists(folder) else None
+
+    def metadata(self):
+        """ Returns the metadata of the current snapshot without loading any column, or None """
+        folder = self.current()
+        if folder is None:
+            return None
+        return json.load(open(os.path.join(folder, 'meta.json'), 'r'))
+
+    def distinct_values(self, columns):
+        """
+        Returns a dictionary mapping the given text columns of the current snapshot to their
+        distinct values, read from the metadata only. It is empty if there is no snapshot.
+        """
+        metadata = self.metadata() or {'columns': []}
+        return dict((column['name'], sorted(column['categories'])) for column in metadata['columns']
+                    if column['name'] in columns and 'categories' in column)
+
+    @timed('snapshot_read')
+    def read(self):
+        """ Returns the data frame and the metadata of the current snapshot, or (None, None) """
+        folder = self.current()
+        if folder is None:
+            return None, None
+        metadata = json.load(open(os.path.join(folder, 'meta.json'), 'r'))
+
+        columns = []
+        for column in metadata['columns']:
+            values = np.load(os.path.join(folder, column['file']), mmap_mode = 'r')
+            if column['kind'] == 'categorical':
+                values = pd.Categorical.from_codes(values, column['categories'])
+            elif column['kind'] == 'text':
+                # missing values have the code -1, which picks the trailing None
+                values = np.array(column['categories'] + [None], dtype = object).take(values)
+            columns.append((column['name'], values))
+
+        return frame_from_columns(columns), metadata
+
+    @timed('snapshot_write')
+    def write(self, df, **metadata):
+        """
+        Writes the data frame as the new current snapshot.
+
+        Args:
+            df: the data frame to store.
+            metadata: json serializable values stored with the snapshot.
+
+        returns:
+            the metadata written with the snapshot.
+        """
+        name = uuid.uuid4().hex
+        tmp_folder = os.path.join(self.path, 'tmp-' + name)
+        os.makedirs(tmp_folder)
+
+        columns = []
+        for i, column in enumerate(df.columns):
+            series = df[column]
+            entry = {'name': column, 'file': '{}.npy'.format(i), 'kind': 'array'}
+            if str(series.dtype) == 'category' or series.dtype == object:
+                categorical = series.astype('category')
+                entry['kind'] = 'categorical' if column in CATEGORICAL_COLUMNS else 'text'
+                entry['categories'] = list(categorical.cat.categories)
+                values = categorical.cat.codes.values
+            else:
+                values = series.values
+            np.save(os.path.join(tmp_folder, entry['file']), values)
+            columns.append(entry)
+
+        metadata = dict(metadata, name = name, rows = len(df), columns = columns)
+        with open(os.path.join(tmp_folder, 'meta.json'), 'w') as f:
+            json.dump(metadata, f, default = str)
+
+        os.rename(tmp_folder, os.path.join(self.path, name))
+        tmp_pointer = self.pointer_path + '.' + name
+        with open(tmp_pointer, 'w') as f:
+            f.write(name)
+        os.rename(tmp_pointer, self.pointer_path)
+
+        self.clean()
+        return metadata
+
+    def clean(self):
+        """ Removes the oldest snapshots beyond keep, and temporary folders older than an hour """
+        current = self.current()
+        snapshots, stale = [], []
+        for name in os.listdir(self.path):
+            folder = os.path.join(self.path, name)
+            if not os.path.isdir(folder):
+                continue
+            if not name.startswith('tmp-'):
+                snapshots.append(folder)
+            elif time.time() - os.path.getmtime(folder) > 60 * 60:
+                # left behind by a write that failed
+                stale.append(folder)
+
+        snapshots.sort(key = os.path.getmtime, reverse = True)
+        stale += [folder for folder in snapshots[self.keep:] if folder != current]
+        for folder in stale:
+            shutil.rmtree(folder, ignore_errors = True)
+
+    def clear(self):
+        """ Removes the pointer, so the next read finds no snapshot """
+        if os.path.exists(self.pointer_path):
+            os.remove(self.pointer_path)
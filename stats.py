@@ -0,0 +1,252 @@
+"""
+Vectorized statistics comparing the experiment arms of an experiment to its control arm.
+
+Every metric counts customers, and trial counts all of them, so a metric is compared both as
+a count, the experiment/regular ratio the dashboard plots, and as a rate per trial. Counts are
+treated as Poisson and rates as binomial, and the intervals of both ratios come from the delta
+method on their logarithm. All arms, days and metrics are computed at once with NumPy.
+"""
+import math
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from cube import METRICS, sum_by
+
+
+# the experimentmodeid of the control (regular) arm
+CONTROL_MODE = 1
+
+# the metric counting every customer, the denominator of the rates
+TRIAL_METRIC = 'trial'
+
+# the columns of ArmComparison.summary, besides the arm and metric ones
+SUMMARY_COLUMNS = ['arm_count', 'control_count', 'ratio', 'ratio_lower', 'ratio_upper', 'p_value',
+                   'arm_rate', 'arm_rate_lower', 'arm_rate_upper',
+                   'control_rate', 'control_rate_lower', 'control_rate_upper',
+                   'rate_ratio', 'rate_ratio_lower', 'rate_ratio_upper', 'rate_p_value']
+
+
+def normal_sf(z):
+    """ Returns the upper tail probability of the standard normal distribution at every z """
+    z = np.asarray(z, dtype = float)
+    # Abramowitz and Stegun 7.1.26 for erfc, with an absolute error below 1.5e-7
+    x = np.abs(z) / math.sqrt(2)
+    t = 1 / (1 + 0.3275911 * x)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    upper = 0.5 * poly * np.exp(-x * x)
+    with np.errstate(invalid = 'ignore'):
+        return np.where(z >= 0, upper, 1 - upper)
+
+
+def p_values(z):
+    """ Returns the two sided p-values of z statistics """
+    return 2 * normal_sf(np.abs(z))
+
+
+def z_value(confidence):
+    """ Returns the z of a two sided normal interval covering confidence, e.g. 1.96 for 0.95 """
+    low, high = 0.0, 40.0
+    for _ in range(100):
+        mid = (low + high) / 2
+        if math.erfc(mid / math.sqrt(2)) > 1 - confidence:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+def wilson_interval(successes, trials, confidence = 0.95):
+    """ Returns the lower and upper Wilson score interval bounds of binomial proportions """
+    z = z_value(confidence)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        n = np.asarray(trials, dtype = float)
+        p = np.asarray(successes, dtype = float) / n
+        denominator = 1 + z ** 2 / n
+        center = (p + z ** 2 / (2 * n)) / denominator
+        half = z * np.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / denominator
+    return np.clip(center - half, 0, 1), np.clip(center + half, 0, 1)
+
+
+def log_ratio_test(ratio, variance, z):
+    """
+    Returns the interval bounds, z statistics and p-values of ratios against 1.
+
+    Args:
+        ratio: the ratios.
+        variance: the variances of the logarithm of the ratios.
+        z: the z of the intervals, see z_value.
+
+    Ratios without a finite, positive variance get nan bounds and p-values.
+    """
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        se = np.sqrt(variance)
+        se = np.where(np.isfinite(se) & (se > 0), se, np.nan)
+        lower = ratio * np.exp(-z * se)
+        upper = ratio * np.exp(z * se)
+        statistic = np.log(ratio) / se
+    return lower, upper, statistic, p_values(statistic)
+
+
+def count_ratio(arm, control):
+    """ Returns the ratios of arm to control counts and the variances of their logarithm """
+    arm = np.asarray(arm, dtype = float)
+    control = np.asarray(control, dtype = float)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        ratio = arm / control
+        variance = 1 / arm + 1 / control
+    return np.where(np.isfinite(ratio), ratio, np.nan), variance
+
+
+def rate_ratio(arm, arm_trials, control, control_trials):
+    """ Returns the ratios of arm to control rates and the variances of their logarithm """
+    arm = np.asarray(arm, dtype = float)
+    control = np.asarray(control, dtype = float)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        arm_rate = arm / arm_trials
+        control_rate = control / control_trials
+        ratio = arm_rate / control_rate
+        variance = (1 - arm_rate) / arm + (1 - control_rate) / control
+    return np.where(np.isfinite(ratio), ratio, np.nan), variance
+
+
+class ArmComparison:
+    """
+    Compares every experiment arm to the control arm, for every metric and day at once.
+
+    Args:
+        daily: a frame with the metric sums of one experiment per arm and day, such as the
+            one of cube.sum_by(df, ['experimentmodeid', 'experimentmodename', 'theday']).
+        metrics: the metric columns to compare.
+        confidence: the coverage of the confidence intervals.
+        control: the experimentmodeid of the control arm.
+
+    Each arm is compared over the days where both it and the control arm have data. The
+    arrays are shaped (arms, days, metrics). The cumulative ones compare all the days up to
+    each day, and the total ones, shaped (arms, metrics), compare all the days together.
+    """
+
+    def __init__(self, daily, metrics = METRICS, confidence = 0.95, control = CONTROL_MODE):
+        self.metrics = list(metrics)
+        self.confidence = confidence
+        self.control = control
+        self.days = np.sort(daily['theday'].unique())
+
+        mode_ids = np.sort(daily['experimentmodeid'].unique())
+        names = daily.drop_duplicates('experimentmodeid').set_index('experimentmodeid')['experimentmodename']
+        self.arm_ids = [mode_id for mode_id in mode_ids if mode_id != control]
+        self.arm_names = [names[mode_id] for mode_id in self.arm_ids]
+
+        # dense (modes, days, metrics) sums, with the control mode last even if it has no data
+        modes = list(self.arm_ids) + [control]
+        mode_positions = dict((mode_id, i) for i, mode_id in enumerate(modes))
+        rows = daily['experimentmodeid'].map(mode_positions).values.astype(int)
+        columns = np.searchsorted(self.days, daily['theday'].values)
+        counts = np.zeros((len(modes), len(self.days), len(self.metrics)))
+        np.add.at(counts, (rows, columns), daily[self.metrics].values.astype(float))
+        present = np.zeros((len(modes), len(self.days)), dtype = bool)
+        present[rows, columns] = True
+
+        self.matched = present[:-1] & present[-1:]
+        self.arm_counts = np.where(self.matched[:, :, None], counts[:-1], 0)
+        self.control_counts = np.where(self.matched[:, :, None], counts[-1:], 0)
+
+        z = z_value(confidence)
+        daily_ratio, _ = count_ratio(self.arm_counts, self.control_counts)
+        self.daily_ratio = np.where(self.matched[:, :, None], daily_ratio, np.nan)
+
+        cumulative_arm = self.arm_counts.cumsum(axis = 1)
+        cumulative_control = self.control_counts.cumsum(axis = 1)
+        self.cumulative_ratio, variance = count_ratio(cumulative_arm, cumulative_control)
+        self.cumulative_lower, self.cumulative_upper, _, self.cumulative_p_value = \
+            log_ratio_test(self.cumulative_ratio, variance, z)
+
+        self.arm_total = self.arm_counts.sum(axis = 1)
+        self.control_total = self.control_counts.sum(axis = 1)
+        self.ratio, variance = count_ratio(self.arm_total, self.control_total)
+        self.ratio_lower, self.ratio_upper, _, self.p_value = log_ratio_test(self.ratio, variance, z)
+
+        # the rates need the trials of every arm, so they are only there if trial is a metric
+        if TRIAL_METRIC in self.metrics:
+            trial = self.metrics.index(TRIAL_METRIC)
+            arm_trials = self.arm_total[:, trial:trial + 1]
+            control_trials = self.control_total[:, trial:trial + 1]
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                self.arm_rate = self.arm_total / arm_trials
+                self.control_rate = self.control_total / control_trials
+            self.arm_rate_lower, self.arm_rate_upper = wilson_interval(self.arm_total, arm_trials, confidence)
+            self.control_rate_lower, self.control_rate_upper = \
+                wilson_interval(self.control_total, control_trials, confidence)
+            self.rate_ratio, variance = rate_ratio(self.arm_total, arm_trials, self.control_total, control_trials)
+            self.rate_ratio_lower, self.rate_ratio_upper, _, self.rate_p_value = \
+                log_ratio_test(self.rate_ratio, variance, z)
+        else:
+            nan = np.full(self.arm_total.shape, np.nan)
+            self.arm_rate = self.arm_rate_lower = self.arm_rate_upper = nan
+            self.control_rate = self.control_rate_lower = self.control_rate_upper = nan
+            self.rate_ratio = self.rate_ratio_lower = self.rate_ratio_upper = self.rate_p_value = nan
+
+    @property
+    def nbytes(self):
+        """ Memory used by the computed arrays """
+        return sum(value.nbytes for value in vars(self).values() if isinstance(value, np.ndarray))
+
+    def arm_index(self, arm):
+        """ Returns the position of an arm, given by experimentmodeid, in the arm axis of the arrays """
+        return self.arm_ids.index(arm)
+
+    def series(self, arm, metric):
+        """
+        Returns the per day comparison of one arm and metric, over the days where both arms have data.
+
+        It has the theday, arm, control and ratio columns for each day alone, and the
+        cumulative_ratio, cumulative_lower, cumulative_upper and cumulative_p_value columns for
+        all the days up to each day.
+        """
+        i = self.arm_index(arm)
+        m = self.metrics.index(metric)
+        matched = self.matched[i]
+        return pd.DataFrame({
+            'theday': self.days[matched],
+            'arm': self.arm_counts[i, matched, m],
+            'control': self.control_counts[i, matched, m],
+            'ratio': self.daily_ratio[i, matched, m],
+            'cumulative_ratio': self.cumulative_ratio[i, matched, m],
+            'cumulative_lower': self.cumulative_lower[i, matched, m],
+            'cumulative_upper': self.cumulative_upper[i, matched, m],
+            'cumulative_p_value': self.cumulative_p_value[i, matched, m]
+        }, columns = ['theday', 'arm', 'control', 'ratio', 'cumulative_ratio', 'cumulative_lower',
+                      'cumulative_upper', 'cumulative_p_value'])
+
+    def summary(self):
+        """ Returns a frame comparing the totals of every arm and metric, one row per arm and metric """
+        arms, metrics = len(self.arm_ids), len(self.metrics)
+        columns = [('experimentmodeid', np.repeat(self.arm_ids, metrics)),
+                   ('experimentmodename', np.repeat(self.arm_names, metrics)),
+                   ('metric', np.tile(self.metrics, arms))]
+        for column in SUMMARY_COLUMNS:
+            columns.append((column, getattr(self, column.replace('_count', '_total')).ravel()))
+        return pd.DataFrame(OrderedDict(columns))
+
+
+def compare_experiments(df, metrics = METRICS, confidence = 0.95, control = CONTROL_MODE):
+    """
+    Returns the ArmComparison.summary of every experiment in df, one row per experiment, arm and metric.
+
+    Args:
+        df: the dashboard rows or the cube, with the experimenttypename, experimentmodeid,
+            experimentmodename and theday columns.
+        metrics: the metrics to compare.
+        confidence: the coverage of the confidence intervals.
+        control: the experimentmodeid of the control arm.
+    """
+    daily = sum_by(df, ['experimenttypename', 'experimentmodeid', 'experimentmodename', 'theday'], metrics)
+    summaries = []
+    for experiment, experiment_daily in daily.groupby('experimenttypename', sort = True):
+        summary = ArmComparison(experiment_daily, metrics, confidence, control).summary()
+        summary.insert(0, 'experimenttypename', experiment)
+        summaries.append(summary)
+    if not summaries:
+        return pd.DataFrame(columns = ['experimenttypename', 'experimentmodeid', 'experimentmodename', 'metric'] + SUMMARY_COLUMNS)
+    return pd.concat(summaries, ignore_index = True)
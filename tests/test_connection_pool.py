@@ -0,0 +1,48 @@
+import sqlite3
+import unittest
+
+from connection_pool import ConnectionPool, is_alive
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = []
+
+        def connect():
+            conn = sqlite3.connect(':memory:', check_same_thread = False)
+            self.connections.append(conn)
+            return conn
+        self.connect = connect
+
+    def test_reuses_connections(self):
+        pool = ConnectionPool(self.connect, 2, ping_after = 0)
+        results = pool.map(lambda conn, n: conn.execute('select ?', (n,)).fetchone()[0], range(10))
+        pool.close()
+        self.assertEqual(results, range(10))
+        self.assertLessEqual(len(self.connections), 2)
+
+    def test_replaces_dead_connections(self):
+        pool = ConnectionPool(self.connect, 1, ping_after = 0)
+        with pool.connection() as conn:
+            pass
+        # dropped while idle, as by the server or a NAT timeout
+        conn.close()
+        self.assertFalse(is_alive(conn))
+        with pool.connection() as replacement:
+            self.assertIsNot(replacement, conn)
+            self.assertEqual(replacement.execute('select 1').fetchone()[0], 1)
+        pool.close()
+
+    def test_broken_connections_are_dropped(self):
+        pool = ConnectionPool(self.connect, 1)
+        with self.assertRaises(ValueError):
+            with pool.connection() as conn:
+                raise ValueError('query failed')
+        with pool.connection() as replacement:
+            self.assertIsNot(replacement, conn)
+        pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import unittest
+
+import psycopg2
+
+import data_extractor
+from data_extractor import DataExtractor
+
+
+BASE_QUERY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sql', 'base_sql_grouped.sql')
+
+
+class FakeCursor:
+    """ A cursor returning the rows of its connection, recording what is done with it """
+
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
+        self.description = None
+        self.rows = None
+
+    def execute(self, query):
+        if self.conn.fail:
+            raise psycopg2.ProgrammingError('failing query')
+        self.conn.log.append(('execute', self.conn.autocommit))
+        self.description = [(column,) for column in self.conn.columns]
+        self.rows = list(self.conn.rows)
+
+    def fetchmany(self, size):
+        self.conn.log.append(('fetch', self.conn.autocommit))
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        self.conn.log.append(('close', self.conn.autocommit))
+
+
+class FakeConnection:
+    """ A stand in for a psycopg2 connection in autocommit mode, as the app configures them """
+
+    def __init__(self, rows, fail = False):
+        self.columns = ['experimenttypename', 'trial']
+        self.rows = rows
+        self.fail = fail
+        self.autocommit = True
+        self.log = []
+
+    def cursor(self, name = None, **kwargs):
+        self.log.append(('cursor', name, kwargs))
+        return FakeCursor(self, name)
+
+    def rollback(self):
+        self.log.append(('rollback', self.autocommit))
+
+
+class NamedCursorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.is_postgres = data_extractor.is_postgres
+        data_extractor.is_postgres = lambda conn: True
+        self.extractor = DataExtractor({'exp1': {'dates': ['2018-09-01', '2018-09-10']}}, BASE_QUERY, extract = False)
+
+    def tearDown(self):
+        data_extractor.is_postgres = self.is_postgres
+
+    def test_streams_in_a_transaction(self):
+        conn = FakeConnection([('exp1', 1)] * 25)
+        chunks = list(self.extractor.iter_query('select', conn, 10))
+        self.assertEqual([len(chunk) for chunk in chunks], [10, 10, 5])
+        self.assertEqual(conn.log[0], ('cursor', 'experiments_stream', {}))
+        # every statement runs inside the transaction, which ends before autocommit comes back
+        self.assertTrue(all(entry[1] is False for entry in conn.log[1:]))
+        self.assertEqual(conn.log[-2:], [('close', False), ('rollback', False)])
+        self.assertTrue(conn.autocommit)
+
+    def test_failing_query_ends_the_transaction(self):
+        conn = FakeConnection([], fail = True)
+        with self.assertRaises(psycopg2.ProgrammingError):
+            list(self.extractor.iter_query('select', conn, 10))
+        self.assertEqual(conn.log[-2:], [('close', False), ('rollback', False)])
+        self.assertTrue(conn.autocommit)
+
+    def test_empty_result_keeps_the_columns(self):
+        conn = FakeConnection([])
+        chunks = list(self.extractor.iter_query('select', conn, 10))
+        self.assertEqual([len(chunk) for chunk in chunks], [0])
+        self.assertEqual(list(chunks[0].columns), ['experimenttypename', 'trial'])
+
+
+@unittest.skipUnless(os.environ.get('TEST_POSTGRES_DSN'), 'needs a PostgreSQL database in TEST_POSTGRES_DSN')
+class PostgresCursorTest(unittest.TestCase):
+
+    def test_streams_on_an_autocommit_connection(self):
+        conn = psycopg2.connect(os.environ['TEST_POSTGRES_DSN'])
+        conn.set_session(readonly = True, autocommit = True)
+        extractor = DataExtractor({'exp1': {'dates': ['2018-09-01', '2018-09-10']}}, BASE_QUERY, extract = False)
+        try:
+            query = "select 'exp1' as experimenttypename, n % 2 as trial from generate_series(1, 25) as n"
+            chunks = list(extractor.iter_query(query, conn, 10))
+            self.assertEqual([len(chunk) for chunk in chunks], [10, 10, 5])
+            self.assertEqual(sum(int(chunk['trial'].sum()) for chunk in chunks), 13)
+            self.assertTrue(conn.autocommit)
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import itertools
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from filter_index import FilterIndex
+
+
+def random_cube(rows = 2000, seed = 0):
+    """ Returns a frame with the filter columns of the cube and a row column identifying the rows """
+    random = np.random.RandomState(seed)
+    return pd.DataFrame({
+        'row': np.arange(rows),
+        'experimenttypename': random.choice(['exp1', 'exp2', 'exp3'], rows),
+        'thedayunix': 1535932800 + 86400 * random.randint(0, 30, rows),
+        'isdesktop': random.randint(0, 2, rows),
+        'culturekey': random.choice(['en-US', 'de-DE', 'fr-FR', 'ja-JP'], rows),
+        'channel': random.choice(['paid', 'organic', 'direct'], rows),
+        'segment': random.choice(['new', 'returning'], rows)
+    })
+
+
+def mask_select(df, date_range, isdesktop, experiment, language, channels, segments):
+    """ Returns the rows matching the filters with one boolean mask per filter """
+    mask = (df['thedayunix'] >= date_range[0]) & (df['thedayunix'] <= date_range[1])
+    if experiment is not None:
+        mask &= df['experimenttypename'] == experiment
+    if isdesktop is not None:
+        mask &= df['isdesktop'] == isdesktop
+    for column, values in [('culturekey', language), ('channel', channels), ('segment', segments)]:
+        if values:
+            mask &= df[column].isin(values)
+    return df[mask]
+
+
+class FilterIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.df = random_cube()
+        self.index = FilterIndex(self.df)
+
+    def assertSameRows(self, filters):
+        expected = np.sort(mask_select(self.df, *filters)['row'].values)
+        actual = self.index.select(*filters)
+        np.testing.assert_array_equal(np.sort(actual['row'].values), expected, err_msg = str(filters))
+        # the rows of an experiment come out sorted by day
+        if filters[2] is not None:
+            self.assertTrue((np.diff(actual['thedayunix'].values) >= 0).all())
+
+    def test_matches_boolean_masks(self):
+        date_ranges = [[0, 2 ** 31], [1535932800 + 86400 * 5, 1535932800 + 86400 * 12],
+                       [1535932800 + 86400 * 7, 1535932800 + 86400 * 7]]
+        for date_range, isdesktop, experiment, language, channels, segments in itertools.product(
+                date_ranges, [None, 0, 1], [None, 'exp1', 'exp3'], [None, ['en-US'], ['de-DE', 'ja-JP']],
+                [None, ['paid', 'direct']], [None, [], ['new']]):
+            self.assertSameRows([date_range, isdesktop, experiment, language, channels, segments])
+
+    def test_unknown_values_select_nothing(self):
+        self.assertEqual(len(self.index.select([0, 2 ** 31], None, 'unknown', None, None, None)), 0)
+        self.assertSameRows([[0, 2 ** 31], None, 'exp2', ['xx-XX'], None, None])
+        self.assertSameRows([[0, 2 ** 31], None, 'exp2', ['xx-XX', 'fr-FR'], None, None])
+
+    def test_date_range_outside_the_data(self):
+        self.assertEqual(len(self.index.select([0, 1000], None, 'exp1', None, None, None)), 0)
+        self.assertEqual(len(self.index.select([2 ** 31, 2 ** 32], None, None, None, None, None)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
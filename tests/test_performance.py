@@ -0,0 +1,39 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from performance import DailyPerformance
+from resampling import Resampler
+from rollups import add_periods
+
+
+def random_cube(days = 28, seed = 0):
+    """ Returns a cube of two arms with a row per arm, day and device, and the week and month labels """
+    random = np.random.RandomState(seed)
+    dates = pd.date_range('2018-09-03', periods = days).strftime('%Y-%m-%d')
+    rows = [(mode, name, day, device) for mode, name in [(1, 'Regular'), (2, 'Experiment')]
+            for day in dates for device in [0, 1]]
+    cube = pd.DataFrame(rows, columns = ['experimentmodeid', 'experimentmodename', 'theday', 'isdesktop'])
+    cube['trial'] = random.poisson(100, len(cube))
+    cube['paid'] = random.poisson(20, len(cube))
+    return add_periods(cube)
+
+
+class DailyPerformanceTest(unittest.TestCase):
+
+    def test_totals_do_not_depend_on_the_period(self):
+        cube = random_cube()
+        performances = [DailyPerformance(cube, ['trial', 'paid'], period = period, resampler = Resampler(500, seed = 0))
+                        for period in ['theday', 'theweek', 'themonth']]
+        self.assertEqual([len(performance.daily) for performance in performances], [56, 8, 2])
+        for performance in performances[1:]:
+            for key in ['ratio_lower', 'ratio_upper', 'p_value']:
+                np.testing.assert_array_equal(performance.bounds[key], performances[0].bounds[key])
+            for column in ['total_performance', 'total_performance_lowerbound', 'total_performance_p_value']:
+                np.testing.assert_array_equal(performance.ratio_frame('paid')[column].unique(),
+                                              performances[0].ratio_frame('paid')[column].unique())
+
+
+if __name__ == '__main__':
+    unittest.main()
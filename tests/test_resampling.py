@@ -0,0 +1,103 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from resampling import Resampler, bootstrap_weights
+from stats import ArmComparison
+
+
+def poisson_days(days = 30, rates = (100, 20), ratio = 1.0, seed = 0):
+    """ Returns the (days, metrics) Poisson counts of an arm and of a control arm with the given true ratio """
+    random = np.random.RandomState(seed)
+    control = random.poisson(rates, (days, len(rates)))
+    arm = random.poisson(np.multiply(rates, ratio), (days, len(rates)))
+    return arm.astype(float), control.astype(float)
+
+
+class BootstrapTest(unittest.TestCase):
+
+    def test_weights_draw_every_unit_count(self):
+        weights = bootstrap_weights(np.random.RandomState(0), 50, 7)
+        self.assertEqual(weights.shape, (50, 7))
+        self.assertTrue((weights >= 0).all())
+        np.testing.assert_array_equal(weights.sum(axis = 1), 7)
+
+    def test_seeded_results_are_deterministic(self):
+        arm, control = poisson_days(ratio = 1.1)
+        first = Resampler(1000, seed = 3, batch_size = 300).bootstrap(arm, control)
+        second = Resampler(1000, seed = 3, batch_size = 300).bootstrap(arm, control)
+        np.testing.assert_array_equal(first, second)
+
+    def test_processes_give_the_same_results(self):
+        arm, control = poisson_days(ratio = 1.1)
+        resampler = Resampler(1000, seed = 3, processes = 2, batch_size = 300)
+        try:
+            pooled = resampler.bootstrap(arm, control), resampler.permutation(arm, control)
+        finally:
+            resampler.close()
+        local = Resampler(1000, seed = 3, batch_size = 300)
+        np.testing.assert_array_equal(pooled[0], local.bootstrap(arm, control))
+        np.testing.assert_array_equal(pooled[1], local.permutation(arm, control))
+
+    def test_bounds_cover_the_observed_ratio(self):
+        arm, control = poisson_days(ratio = 1.1)
+        observed = arm.sum(axis = 0) / control.sum(axis = 0)
+        for paired in [True, False]:
+            lower, upper = Resampler(2000, seed = 0).bootstrap(arm, control, paired = paired)
+            self.assertTrue((lower < observed).all() and (observed < upper).all())
+
+    def test_too_few_units(self):
+        arm, control = poisson_days(days = 9, ratio = 1.1)
+        resampler = Resampler(100, seed = 0)
+        lower, upper = resampler.bootstrap(arm, control)
+        self.assertTrue(np.isnan(lower).all() and np.isnan(upper).all())
+        self.assertTrue(np.isnan(resampler.permutation(arm, control)).all())
+        lower, upper = Resampler(100, seed = 0, min_units = 2).bootstrap(arm[:2], control[:2])
+        self.assertTrue(np.isfinite(lower).all() and np.isfinite(upper).all())
+
+
+class PermutationTest(unittest.TestCase):
+
+    def test_identical_arms(self):
+        arm, control = poisson_days()
+        np.testing.assert_array_equal(Resampler(200, seed = 0).permutation(arm, arm), [1, 1])
+
+    def test_clear_effect(self):
+        arm, control = poisson_days(ratio = 2)
+        for paired in [True, False]:
+            p_value = Resampler(500, seed = 0).permutation(arm, control, paired = paired)
+            np.testing.assert_allclose(p_value, 1.0 / 501)
+
+    def test_false_positive_rate_under_the_null(self):
+        resampler = Resampler(200, seed = 0)
+        p_values = np.array([resampler.permutation(*poisson_days(seed = seed)) for seed in range(300)])
+        rate = (p_values < 0.05).mean(axis = 0)
+        self.assertTrue(((rate > 0.01) & (rate < 0.1)).all(), rate)
+
+
+class CompareTest(unittest.TestCase):
+
+    def comparison(self, days):
+        arm, control = poisson_days(days = days, ratio = 1.1)
+        daily = pd.concat([pd.DataFrame({'experimentmodeid': mode, 'experimentmodename': name, 'theday': np.arange(days),
+                                         'trial': counts[:, 0], 'paid': counts[:, 1]})
+                           for mode, name, counts in [(1, 'Regular', control), (2, 'Experiment', arm)]])
+        return ArmComparison(daily, ['trial', 'paid'])
+
+    def test_resamples_enough_days(self):
+        comparison = self.comparison(30)
+        result = Resampler(500, seed = 0).compare(comparison)
+        self.assertFalse(np.allclose(result['ratio_lower'], comparison.ratio_lower))
+        self.assertTrue(np.isfinite(result['p_value']).all())
+
+    def test_few_days_keep_the_delta_method_bounds(self):
+        comparison = self.comparison(5)
+        result = Resampler(500, seed = 0).compare(comparison)
+        np.testing.assert_array_equal(result['ratio_lower'], comparison.ratio_lower)
+        np.testing.assert_array_equal(result['ratio_upper'], comparison.ratio_upper)
+        self.assertTrue(np.isnan(result['p_value']).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
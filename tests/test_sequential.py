@@ -0,0 +1,58 @@
+import unittest
+
+import numpy as np
+
+from sequential import SequentialState
+
+
+def simulated_state(ratio, days = 60, simulations = 400, rate = 50, alpha = 0.05, tau2 = 0.01, seed = 0):
+    """ Returns a SequentialState with a metric per simulation of daily Poisson counts with the true ratio """
+    random = np.random.RandomState(seed)
+    control = random.poisson(rate, (days, simulations))
+    arm = random.poisson(rate * ratio, (days, simulations))
+    state = SequentialState(range(simulations), alpha = alpha, tau2 = tau2)
+    return state.update(np.arange(days), arm, control)
+
+
+class SequentialStateTest(unittest.TestCase):
+
+    def test_coverage_at_the_nominal_rate(self):
+        # the running bounds are intersected, so the last ones cover the ratio only if every day did
+        for ratio in [1.0, 1.3]:
+            state = simulated_state(ratio)
+            covered = (state.lower[-1] <= ratio) & (ratio <= state.upper[-1])
+            self.assertGreaterEqual(covered.mean(), 0.95 - 2 * np.sqrt(0.95 * 0.05 / len(covered)))
+
+    def test_p_values_agree_with_the_bounds(self):
+        state = simulated_state(1.1)
+        rejected = (state.lower > 1) | (state.upper < 1)
+        np.testing.assert_array_equal(rejected, state.p_value < 0.05)
+
+    def test_running_bounds_only_narrow(self):
+        state = simulated_state(1.1, simulations = 20)
+        self.assertTrue((np.diff(state.lower, axis = 0) >= 0).all())
+        self.assertTrue((np.diff(state.upper, axis = 0) <= 0).all())
+        self.assertTrue((np.diff(state.p_value, axis = 0) <= 0).all())
+
+    def test_updates_in_parts_match_a_single_update(self):
+        random = np.random.RandomState(1)
+        arm, control = random.poisson(30, (2, 40, 3))
+        whole = SequentialState(range(3)).update(np.arange(40), arm, control)
+        parts = SequentialState(range(3))
+        for start, end in [(0, 1), (1, 10), (10, 10), (10, 40)]:
+            parts = parts.extended(np.arange(start, end), arm[start:end], control[start:end])
+        np.testing.assert_array_equal(parts.days, whole.days)
+        for column in ['lower', 'upper', 'p_value']:
+            np.testing.assert_allclose(getattr(parts, column), getattr(whole, column))
+
+    def test_extended_leaves_the_state_as_is(self):
+        state = SequentialState(range(2)).update(np.arange(5), np.full((5, 2), 10), np.full((5, 2), 8))
+        upper = state.upper.copy()
+        for shared in [True, False]:
+            extended = state.extended(np.arange(5, 8), np.full((3, 2), 30), np.full((3, 2), 8), shared = shared)
+            self.assertEqual((state.size, len(extended.days)), (5, 8))
+            np.testing.assert_array_equal(state.upper, upper)
+
+
+if __name__ == '__main__':
+    unittest.main()
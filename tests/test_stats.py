@@ -0,0 +1,67 @@
+import math
+import unittest
+
+import numpy as np
+
+from stats import normal_sf, z_value, wilson_interval, log_ratio_test, count_ratio, rate_ratio
+
+
+class NormalTest(unittest.TestCase):
+
+    def test_z_value(self):
+        self.assertAlmostEqual(z_value(0.95), 1.959964, places = 6)
+        self.assertAlmostEqual(z_value(0.99), 2.575829, places = 6)
+        self.assertAlmostEqual(z_value(0.90), 1.644854, places = 6)
+
+    def test_normal_sf_matches_erfc(self):
+        z = np.linspace(-6, 6, 241)
+        expected = [0.5 * math.erfc(value / math.sqrt(2)) for value in z]
+        np.testing.assert_allclose(normal_sf(z), expected, atol = 1.5e-7)
+
+
+class WilsonTest(unittest.TestCase):
+
+    def test_known_intervals(self):
+        # 81 of 263 is the example of Newcombe (1998), 0.2553 to 0.3662
+        lower, upper = wilson_interval([50, 0, 10, 81], [100, 10, 10, 263])
+        np.testing.assert_allclose(lower, [0.403832, 0, 0.722467, 0.255289], atol = 1e-6)
+        np.testing.assert_allclose(upper, [0.596168, 0.277533, 1, 0.366210], atol = 1e-6)
+
+    def test_confidence(self):
+        lower, upper = wilson_interval(50, 100, confidence = 0.99)
+        self.assertAlmostEqual(float(lower), 0.375280, places = 6)
+        self.assertAlmostEqual(float(upper), 0.624720, places = 6)
+
+
+class DeltaMethodTest(unittest.TestCase):
+
+    def test_count_ratio(self):
+        ratio, variance = count_ratio([200, 0, 5], [100, 10, 0])
+        np.testing.assert_allclose(ratio[[0, 1]], [2, 0])
+        self.assertTrue(np.isnan(ratio[2]))
+        self.assertAlmostEqual(variance[0], 0.015)
+
+        lower, upper, statistic, p_value = log_ratio_test(ratio[:1], variance[:1], z_value(0.95))
+        # 2 * exp(-/+ 1.959964 * sqrt(0.015))
+        np.testing.assert_allclose(lower, [1.573184], atol = 1e-6)
+        np.testing.assert_allclose(upper, [2.542614], atol = 1e-6)
+        np.testing.assert_allclose(statistic, [math.log(2) / math.sqrt(0.015)])
+        np.testing.assert_allclose(p_value, [math.erfc(statistic[0] / math.sqrt(2))], atol = 3e-7)
+
+    def test_rate_ratio(self):
+        ratio, variance = rate_ratio([30], [100], [20], [100])
+        np.testing.assert_allclose(ratio, [1.5])
+        np.testing.assert_allclose(variance, [0.7 / 30 + 0.8 / 20])
+
+        lower, upper, statistic, p_value = log_ratio_test(ratio, variance, z_value(0.95))
+        np.testing.assert_allclose(lower, [0.915961], atol = 1e-6)
+        np.testing.assert_allclose(upper, [2.456437], atol = 1e-6)
+        np.testing.assert_allclose(p_value, [0.107146], atol = 1e-6)
+
+    def test_no_variance(self):
+        lower, upper, statistic, p_value = log_ratio_test(np.array([1.0, 2.0]), np.array([0.0, np.inf]), 1.96)
+        self.assertTrue(np.isnan(lower).all() and np.isnan(upper).all() and np.isnan(p_value).all())
+
+
+if __name__ == '__main__':
+    unittest.main()